@@ -1,19 +1,4 @@
 -- --- START OF FILE dbcmd.sql ---
--- Create the Imagefeatures table if it doesn't exist
-CREATE TABLE IF NOT EXISTS Imagefeatures (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    filename TEXT NOT NULL,
-    feature_type TEXT NOT NULL,
-    feature_value TEXT,
-    probability REAL
-);
-
--- Create an index on the filename column for faster lookups
-CREATE INDEX IF NOT EXISTS idx_filename ON Imagefeatures (filename);
-
--- Create an index on the feature_value column for faster lookups
-CREATE INDEX IF NOT EXISTS idx_feature_value ON Imagefeatures (feature_value);
-
 -- Create a table for storing feedback history (optional but recommended)
 CREATE TABLE IF NOT EXISTS FeedbackHistory (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -31,4 +16,89 @@ CREATE TABLE IF NOT EXISTS UserSentences (
 );
 
 -- Index for UserSentences
-CREATE INDEX IF NOT EXISTS idx_user_sentences_filename ON UserSentences (filename);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_user_sentences_filename ON UserSentences (filename);
+
+-- Index of stored images, one row per file. Rows keep their id for life,
+-- so listing by id gives a stable order for cursor pagination.
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL UNIQUE,
+    content_hash TEXT,
+    file_size INTEGER,
+    width INTEGER,
+    height INTEGER,
+    added_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Finds an already analysed copy of an uploaded file
+CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash);
+
+-- Dictionary of feature values ("dog", "Red", ...), stored once and referenced by id
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL UNIQUE
+);
+
+-- Scored features of every image: labels, colors, synonyms and user feedback.
+-- region is the part of the image the feature was found in ('Original' for the whole image).
+-- Rows are read in rowid (insertion) order, the first score of an (image, term) pair wins.
+CREATE TABLE IF NOT EXISTS image_terms (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    term_id INTEGER NOT NULL REFERENCES terms (id),
+    feature_type TEXT NOT NULL,
+    region TEXT NOT NULL DEFAULT 'Original',
+    score REAL NOT NULL
+);
+
+-- All features of an image (re-indexing, feedback)
+CREATE INDEX IF NOT EXISTS idx_image_terms_image ON image_terms (image_id);
+
+-- Covering index: posting list (images and scores) of a term without reading the table
+CREATE INDEX IF NOT EXISTS idx_image_terms_term ON image_terms (term_id, image_id, score);
+
+-- File, EXIF and format metadata, one typed value per (image, name):
+-- numbers in value_real, strings (and JSON for structured values) in value_text, bytes in value_blob
+CREATE TABLE IF NOT EXISTS image_metadata (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value_text TEXT,
+    value_real REAL,
+    value_blob BLOB,
+    PRIMARY KEY (image_id, name)
+) WITHOUT ROWID;
+
+-- Flat view of image_terms with the names resolved, for ad hoc queries
+CREATE VIEW IF NOT EXISTS image_features AS
+    SELECT images.filename, image_terms.feature_type, terms.value AS feature_value,
+           image_terms.region, image_terms.score AS probability
+    FROM image_terms
+    JOIN images ON images.id = image_terms.image_id
+    JOIN terms ON terms.id = image_terms.term_id;
+
+-- Durable ingestion queue: one job per upload, one task per file to analyse.
+-- Times are Unix timestamps (seconds).
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+
+-- state: queued, running, done or failed. result: analysed, or how an already indexed
+-- copy was reused (unchanged, copied, renamed). A failed attempt is queued again
+-- at next_attempt_at until max attempts are used up.
+CREATE TABLE IF NOT EXISTS ingest_tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES ingest_jobs (id) ON DELETE CASCADE,
+    filename TEXT NOT NULL,
+    content_hash TEXT,  -- SHA-1 computed while the upload was spooled
+    state TEXT NOT NULL DEFAULT 'queued',
+    result TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    started_at REAL,
+    finished_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_tasks_job ON ingest_tasks (job_id, state);
+CREATE INDEX IF NOT EXISTS idx_ingest_tasks_state ON ingest_tasks (state, next_attempt_at);
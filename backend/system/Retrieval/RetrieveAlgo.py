@@ -1,93 +1,52 @@
 # --- START OF FILE RetrieveAlgo.py --- (Corrected)
 
 import pandas as pd
-import numpy as np
-import os
-from nltk.corpus import wordnet
+from tokenisation.synonymService import get_synonym_service
+from Retrieval.termMatrix import get_term_matrix
 
 class VectorSpaceModel:
-    def __init__(self, db_manager, included_words, query):
+    def __init__(self, db_manager, included_words, query, term_matrix=None, top_k=None):
         self.db_manager = db_manager
         self.included_words = included_words
         self.query = query
+        self.term_matrix = term_matrix or get_term_matrix()
+        self.top_k = top_k  # Only keep the best top_k images (None scores every candidate)
+        self.all_query_terms = None
         self.vector_df = self.create_vector_space_model()
 
     def get_synonyms(self, word, limit=10):
-        synonyms = set()
-        for syn in wordnet.synsets(word):
-            for lemma in syn.lemmas():
-                synonyms.add(lemma.name())
-                if len(synonyms) >= limit:
-                    print(synonyms)
-                    return list(synonyms)
-        print(synonyms)           
-        return list(synonyms)
+        return get_synonym_service().get_synonyms(word, limit=limit)
 
-    def create_vector_space_model(self):
-        # --- Stage 1: Broad Feature Selection ---
-        all_query_terms = self.included_words.copy()
-        for word in self.included_words:
-            all_query_terms.extend(self.get_synonyms(word))
-        all_query_terms = list(set(all_query_terms))
+    def get_all_query_terms(self):
+        # Query words plus their synonyms, looked up once per query
+        if self.all_query_terms is None:
+            all_query_terms = self.included_words.copy()
+            for word in self.included_words:
+                all_query_terms.extend(self.get_synonyms(word))
+            self.all_query_terms = list(set(all_query_terms))
+        return self.all_query_terms
 
-        placeholders = ', '.join(['?'] * len(all_query_terms))
-        broad_sql_query = f"""
-            SELECT DISTINCT filename
-            FROM Imagefeatures
-            WHERE feature_value IN ({placeholders})
+    def create_vector_space_model(self):
         """
-        relevant_filenames_result = self.db_manager.fetch_query_results(broad_sql_query, tuple(all_query_terms))
-
-        if not relevant_filenames_result:
-            return pd.DataFrame()
-
-        relevant_filenames = [os.path.basename(row[0]) for row in relevant_filenames_result]
-        filename_placeholders = ', '.join(['?'] * len(relevant_filenames))
-        filename_where_clause = f"filename IN ({filename_placeholders})"
-
-        # --- Stage 2: Precise Feature Selection ---
-        precise_sql_query = f"""
-            SELECT filename, feature_value, probability
-            FROM Imagefeatures
-            WHERE {filename_where_clause}
+        Score every image that has at least one query term (or synonym) against the query.
+        Uses the precomputed sparse term matrix instead of pivoting Imagefeatures per query.
+        :return: DataFrame indexed by filename with a 'similarity' column.
         """
-        sql_query_result = self.db_manager.fetch_query_results(precise_sql_query, tuple(relevant_filenames))
-
-        if not sql_query_result:
+        all_query_terms = self.get_all_query_terms()
+        if not all_query_terms:
             return pd.DataFrame()
 
-        df = pd.DataFrame(sql_query_result, columns=['filename', 'feature_value', 'probability'])
-        df['filename'] = df['filename'].apply(os.path.basename)
-
-        # --- Pivot (WITHOUT fill_value) ---
-        pivot_df = df.pivot_table(index='filename', columns='feature_value', values='probability', aggfunc='first')
+        if self.top_k is not None:
+            top = self.term_matrix.top_k(self.included_words, all_query_terms, self.top_k)
+            if not top:
+                return pd.DataFrame()
+            filenames, scores = zip(*top)
+            return pd.DataFrame({'similarity': scores}, index=pd.Index(filenames, name='filename'))
 
-        # --- Impute Missing Values (AFTER pivoting) ---
-        # Find a small value to impute (e.g., 1/10th the smallest non-zero probability)
-        min_prob = df['probability'][df['probability'] > 0].min()
-        imputation_value = min_prob / 10.0 if not pd.isna(min_prob) else 0.0001 # Default if no probabilities > 0
-
-        pivot_df = pivot_df.fillna(imputation_value)
-
-        # Ensure all features from the query (and synonyms) are present,
-        # filling any that are still missing *after* the initial imputation
-        for feature in all_query_terms:
-            if feature not in pivot_df.columns:
-                pivot_df[feature] = imputation_value
-
-        
-        # --- Weighting and Normalization ---
-        image_vectors = pivot_df.to_numpy()
-        print(image_vectors)
-        weights = np.array([3.5 if feature in self.included_words else 0.75 for feature in pivot_df.columns])
-        weighted_vectors = image_vectors * weights
-        print(weighted_vectors)
-        norms = np.linalg.norm(weighted_vectors, axis=1, keepdims=True)
-        with np.errstate(divide='ignore', invalid='ignore'):
-            normalized_vectors = np.where(norms != 0, weighted_vectors / norms, 0)
-        vector_df = pd.DataFrame(normalized_vectors, index=pivot_df.index, columns=pivot_df.columns)
-        print(vector_df)
-        return vector_df
+        filenames, scores = self.term_matrix.score(self.included_words, all_query_terms)
+        if not filenames:
+            return pd.DataFrame()
+        return pd.DataFrame({'similarity': scores}, index=pd.Index(filenames, name='filename'))
 
     def construct_sql_query(self):
         return None, None
@@ -95,28 +54,4 @@ class VectorSpaceModel:
     def get_sorted_vector_df(self):
         if self.vector_df.empty:
             return pd.DataFrame()
-
-        query_vector = self.create_query_vector()
-        image_vectors = self.vector_df.to_numpy()
-        similarity_scores = np.dot(image_vectors, query_vector)
-        sorted_df = self.vector_df.copy()
-        sorted_df['similarity'] = similarity_scores
-        sorted_df = sorted_df.sort_values(by='similarity', ascending=False)
-        return sorted_df
-
-    def create_query_vector(self):
-        query_vector = pd.Series(0.0, index=self.vector_df.columns)
-        all_query_terms = self.included_words.copy()
-        for word in self.included_words:
-            all_query_terms.extend(self.get_synonyms(word))
-        all_query_terms = list(set(all_query_terms))
-
-        for term in all_query_terms:
-            if term in query_vector.index:
-                weight = 3.5 if term in self.included_words else 0.75
-                query_vector[term] = weight
-
-        norm = np.linalg.norm(query_vector.to_numpy())
-        if norm > 0:
-            query_vector = query_vector / norm
-        return query_vector.to_numpy()
\ No newline at end of file
+        return self.vector_df.sort_values(by='similarity', ascending=False)
@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import numpy as np
+from sklearn.cluster import KMeans
+from SQLmethods.connectDB import BACKEND_DIR
+from Retrieval.embeddingStore import EmbeddingStore
+
+EMBEDDING_INDEX_PATH = os.environ.get('CBIR_EMBEDDING_INDEX', os.path.join(BACKEND_DIR, 'embeddings'))
+
+class IVFPQ:
+    def __init__(self, n_lists=None, n_subvectors=16, n_centroids=256, n_probe=8, train_size=20000, random_state=0):
+        """
+        Inverted file with product quantization (IVF-PQ) for approximate inner-product search
+        over L2-normalized vectors (where the smallest distance is the largest cosine).
+        Vectors are assigned to the nearest of n_lists coarse centroids, and their residual
+        to that centroid is stored as n_subvectors one-byte codes.
+        :param n_lists: Number of coarse centroids (default: 4 * sqrt(number of vectors))
+        :param n_probe: Lists scanned per query
+        :param train_size: At most this many vectors are used to train the centroids
+        """
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.n_probe = n_probe
+        self.train_size = train_size
+        self.random_state = random_state
+        self.coarse = None     # (n_lists, dim)
+        self.codebooks = None  # (n_subvectors, n_centroids, dim / n_subvectors)
+        self.codes = np.zeros((0, 0), dtype=np.uint8)  # row -> PQ codes
+        self.list_of = np.zeros(0, dtype=np.int64)      # row -> coarse list (-1 if not added)
+        self.members = []  # coarse list -> rows
+        self.trained_size = 0
+
+    def train(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        rng = np.random.default_rng(self.random_state)
+        sample = vectors[rng.choice(n, self.train_size, replace=False)] if n > self.train_size else vectors
+
+        n_lists = min(self.n_lists or int(4 * np.sqrt(n)), len(sample))
+        coarse = KMeans(n_clusters=n_lists, n_init=1, random_state=self.random_state).fit(sample)
+        self.coarse = coarse.cluster_centers_.astype(np.float32)
+
+        n_subvectors = self.n_subvectors
+        while dim % n_subvectors:  # Subvectors must split the dimension evenly
+            n_subvectors -= 1
+        self.n_subvectors = n_subvectors
+        residuals = sample - self.coarse[coarse.labels_]
+        sub_dim = dim // n_subvectors
+        n_centroids = min(self.n_centroids, len(sample))
+        self.codebooks = np.zeros((n_subvectors, n_centroids, sub_dim), dtype=np.float32)
+        for m in range(n_subvectors):
+            sub = residuals[:, m * sub_dim:(m + 1) * sub_dim]
+            self.codebooks[m] = KMeans(n_clusters=n_centroids, n_init=1, random_state=self.random_state).fit(sub).cluster_centers_
+
+        self.codes = np.zeros((0, n_subvectors), dtype=np.uint8)
+        self.list_of = np.zeros(0, dtype=np.int64)
+        self.members = [[] for _ in range(n_lists)]
+        self.trained_size = n
+
+    @staticmethod
+    def nearest(points, centers):
+        # Squared L2 distance without materializing every difference vector
+        distances = (points * points).sum(1)[:, None] - 2 * points @ centers.T + (centers * centers).sum(1)[None, :]
+        return distances.argmin(1)
+
+    def encode(self, vectors, lists):
+        residuals = vectors - self.coarse[lists]
+        sub_dim = residuals.shape[1] // self.n_subvectors
+        codes = np.zeros((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for m in range(self.n_subvectors):
+            codes[:, m] = self.nearest(residuals[:, m * sub_dim:(m + 1) * sub_dim], self.codebooks[m])
+        return codes
+
+    def add(self, rows, vectors):
+        """
+        Add (or re-add) vectors stored at the given rows of the embedding matrix.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        lists = self.nearest(vectors, self.coarse)
+        codes = self.encode(vectors, lists)
+
+        size = int(rows.max()) + 1 if len(rows) else 0
+        if size > len(self.list_of):
+            self.list_of = np.concatenate([self.list_of, np.full(size - len(self.list_of), -1, dtype=np.int64)])
+            self.codes = np.concatenate([self.codes, np.zeros((size - len(self.codes), self.n_subvectors), dtype=np.uint8)])
+        for row, list_id, code in zip(rows.tolist(), lists.tolist(), codes):
+            old = self.list_of[row]
+            if old >= 0:
+                self.members[old].remove(row)
+            self.members[list_id].append(row)
+            self.list_of[row] = list_id
+            self.codes[row] = code
+
+    def remove(self, rows):
+        for row in rows:
+            if row < len(self.list_of) and self.list_of[row] >= 0:
+                self.members[self.list_of[row]].remove(row)
+                self.list_of[row] = -1
+
+    def search(self, query, n_candidates):
+        """
+        Approximate search: scan the n_probe nearest lists with asymmetric distances
+        (exact query, quantized vectors).
+        :return: Candidate rows, closest first.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        coarse_distances = ((self.coarse - query) ** 2).sum(1)
+        probe = np.argsort(coarse_distances)[:self.n_probe]
+        sub_dim = len(query) // self.n_subvectors
+
+        candidate_rows, candidate_distances = [], []
+        for list_id in probe:
+            rows = self.members[list_id]
+            if not rows:
+                continue
+            rows = np.array(rows, dtype=np.int64)
+            residual = (query - self.coarse[list_id]).reshape(self.n_subvectors, 1, sub_dim)
+            tables = ((self.codebooks - residual) ** 2).sum(2)  # (n_subvectors, n_centroids)
+            distances = tables[np.arange(self.n_subvectors), self.codes[rows]].sum(1)
+            candidate_rows.append(rows)
+            candidate_distances.append(distances)
+        if not candidate_rows:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.concatenate(candidate_rows)
+        distances = np.concatenate(candidate_distances)
+        if len(rows) > n_candidates:
+            keep = np.argpartition(distances, n_candidates)[:n_candidates]
+            rows, distances = rows[keep], distances[keep]
+        return rows[np.argsort(distances)]
+
+
+class EmbeddingIndex:
+    def __init__(self, path=EMBEDDING_INDEX_PATH, min_ann_size=2048, rerank=10, compact_ratio=0.25, chunk_rows=65536):
+        """
+        Pooled ViT embeddings of every image (float16, one row per image) for query-by-example.
+        Vectors live in a memory-mapped EmbeddingStore, so nothing is loaded up front and
+        worker processes share the pages.
+        Small collections are searched exactly; from min_ann_size images on an IVF-PQ index
+        picks candidates that are reranked with the exact vectors.
+        :param path: prefix of the embedding store files
+        :param rerank: Candidates reranked per requested result
+        :param compact_ratio: The store is compacted once this share of its rows are tombstones
+        :param chunk_rows: Rows scored at a time by brute-force search
+        """
+        self.path = path
+        self.min_ann_size = min_ann_size
+        self.rerank = rerank
+        self.compact_ratio = compact_ratio
+        self.chunk_rows = chunk_rows
+        self.lock = threading.RLock()
+        self.store = EmbeddingStore(path)
+        self.ann = None
+        self.ann_build_time = None
+        self.maintenance = None  # Background compaction / training thread
+
+    @property
+    def size(self):
+        """Number of live (not tombstoned) images."""
+        return len(self.store.row_of)
+
+    # --- Storage ---
+
+    def add(self, filenames, vectors):
+        """
+        Store the embeddings of images (replacing the previous embedding of a known filename).
+        """
+        vectors = np.asarray(vectors, dtype=np.float16)
+        if len(vectors) == 0:
+            return
+        filenames = [os.path.basename(filename) for filename in filenames]
+        with self.lock:
+            rows, replaced = self.store.append(filenames, vectors)
+            if self.ann is not None:
+                self.ann.remove(replaced)
+                self.ann.add(rows, vectors)
+
+    def remove(self, filenames):
+        """
+        Drop the embeddings of deleted images (tombstoned until the next compaction).
+        """
+        with self.lock:
+            rows = self.store.delete([os.path.basename(filename) for filename in filenames])
+            if self.ann is not None:
+                self.ann.remove(rows)
+
+    def vector_of(self, filename):
+        matrix, _, _ = self.store.snapshot()
+        row = self.store.row_of.get(os.path.basename(filename))
+        return None if row is None else np.asarray(matrix[row], dtype=np.float32)
+
+    def load(self):
+        """
+        Import embeddings saved by older versions as .npy/.json, then train the approximate
+        index if the collection is large enough.
+        :return: True if any embeddings are stored.
+        """
+        legacy_npy, legacy_json = self.path + '.npy', self.path + '.json'
+        if self.store.size == 0 and os.path.exists(legacy_npy) and os.path.exists(legacy_json):
+            with open(legacy_json, 'r') as f:
+                filenames = json.load(f)["filenames"]
+            self.store.append(filenames, np.load(legacy_npy))
+            os.remove(legacy_npy)
+            os.remove(legacy_json)
+            print(f"Moved {len(filenames)} embeddings into the memory-mapped store")
+        self.maybe_rebuild()
+        return self.size > 0
+
+    def maybe_compact(self):
+        """
+        Compact the store once enough rows are tombstones. The live rows are copied without
+        holding the lock; rows are renumbered, so the approximate index is dropped at the
+        swap and retrained afterwards.
+        """
+        if self.store.dead_ratio() < self.compact_ratio:
+            return
+        copied = self.store.copy_live()
+        with self.lock:
+            self.store.swap(copied)
+            self.ann = None
+        self.maybe_rebuild()
+
+    def schedule_maintenance(self):
+        """
+        Run maybe_compact and maybe_rebuild on a background thread (one at a time), so the
+        caller (the ingestion writer) is not blocked. Searches use the old rows and index
+        until the results are swapped in.
+        """
+        with self.lock:
+            if self.maintenance is not None and self.maintenance.is_alive():
+                return
+            if self.store.dead_ratio() < self.compact_ratio and not self.needs_rebuild():
+                return
+            self.maintenance = threading.Thread(target=self._maintain, daemon=True)
+            self.maintenance.start()
+
+    def _maintain(self):
+        try:
+            self.maybe_compact()
+            self.maybe_rebuild()
+        except Exception as e:
+            print(f"Error maintaining the embedding index: {e}")
+
+    # --- Approximate index ---
+
+    def build_ann(self):
+        """
+        (Re)train the IVF-PQ index on every live embedding.
+        """
+        with self.lock:
+            matrix, filenames, size = self.store.snapshot()
+            live = np.array([row for row in range(size) if filenames[row] is not None], dtype=np.int64)
+        start = time.perf_counter()
+        ann = IVFPQ()
+        ann.train(matrix[live].astype(np.float32))
+        for chunk_start in range(0, len(live), self.chunk_rows):
+            rows = live[chunk_start:chunk_start + self.chunk_rows]
+            ann.add(rows, matrix[rows].astype(np.float32))
+        with self.lock:
+            # Rows appended or tombstoned while training
+            matrix, filenames, new_size = self.store.snapshot()
+            ann.remove([row for row in live.tolist() if filenames[row] is None])
+            added = [row for row in range(size, new_size) if filenames[row] is not None]
+            if added:
+                ann.add(added, matrix[added].astype(np.float32))
+            self.ann = ann
+            self.ann_build_time = time.perf_counter() - start
+        print(f"Built IVF-PQ index over {len(live)} embeddings in {self.ann_build_time:.2f}s")
+
+    def maybe_rebuild(self):
+        """
+        Train the approximate index once the collection is large enough, and retrain it
+        whenever the collection has doubled since the last training.
+        """
+        if self.needs_rebuild():
+            self.build_ann()
+
+    def needs_rebuild(self):
+        if self.size < self.min_ann_size:
+            return False
+        return self.ann is None or self.size >= 2 * self.ann.trained_size
+
+    # --- Search ---
+
+    def search(self, query, k, exact=False, exclude=None):
+        """
+        The k images whose embedding has the highest cosine similarity to query.
+        :param query: L2-normalized embedding
+        :param exact: Force brute-force search
+        :param exclude: Filename left out of the results (e.g. the query image itself)
+        :return: List of (filename, score), best first.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        wanted = k + (1 if exclude is not None else 0)
+        with self.lock:
+            # The ANN rows must index this snapshot: adds and compactions change the rows under the lock
+            with self.store.lock:  # Tombstone count of the same snapshot
+                matrix, filenames, size = self.store.snapshot()
+                dead = self.store.dead
+            ann = None if exact else self.ann
+            if size == 0 or wanted <= 0:
+                return []
+            if ann is not None:
+                rows = ann.search(query, wanted * self.rerank)
+
+        if ann is None:
+            # Stream the memory map in chunks, keeping the best rows of each chunk
+            best_rows, best_scores = [], []
+            for start in range(0, size, self.chunk_rows):
+                scores = matrix[start:start + self.chunk_rows].astype(np.float32) @ query
+                keep = min(wanted + dead, len(scores))  # Enough to skip every tombstone
+                top = np.argpartition(-scores, keep - 1)[:keep]
+                best_rows.append(top + start)
+                best_scores.append(scores[top])
+            rows, scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        else:
+            scores = matrix[rows].astype(np.float32) @ query  # Rerank with exact vectors
+
+        results = []
+        for index in np.argsort(-scores).tolist():
+            filename = filenames[rows[index]]
+            if filename is None or filename == exclude:  # Tombstoned or excluded
+                continue
+            results.append((filename, float(scores[index])))
+            if len(results) == k:
+                break
+        return results
+
+    def stats(self):
+        return {
+            "images": self.size,
+            "stored_rows": self.store.size,
+            "tombstones": self.store.dead,
+            "dimension": self.store.dim,
+            "approximate": self.ann is not None,
+            "ann_build_time_s": self.ann_build_time,
+        }
+
+
+def benchmark(index, n_queries=100, k=10, seed=0):
+    """
+    Compare the approximate index with brute-force search on stored embeddings:
+    build time, recall@k and per-query latency (mean and 95th percentile, in ms).
+    """
+    index.build_ann()
+    rng = np.random.default_rng(seed)
+    matrix, filenames, size = index.store.snapshot()
+    live = [row for row in range(size) if filenames[row] is not None]
+    rows = np.sort(rng.choice(live, min(n_queries, len(live)), replace=False))
+    queries = matrix[rows].astype(np.float32)
+
+    timings = {"exact": [], "approximate": []}
+    hits = 0
+    for query in queries:
+        start = time.perf_counter()
+        exact = index.search(query, k, exact=True)
+        timings["exact"].append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        approximate = index.search(query, k)
+        timings["approximate"].append((time.perf_counter() - start) * 1000)
+        hits += len({filename for filename, _ in exact} & {filename for filename, _ in approximate})
+
+    report = {"images": index.size, "queries": len(queries), "k": k,
+              "build_time_s": round(index.ann_build_time, 3),
+              f"recall@{k}": round(hits / (len(queries) * k), 4)}
+    for name, values in timings.items():
+        report[f"{name}_mean_ms"] = round(float(np.mean(values)), 3)
+        report[f"{name}_p95_ms"] = round(float(np.percentile(values, 95)), 3)
+    return report
+
+
+# One embedding index per process
+_embedding_index = None
+_embedding_index_lock = threading.Lock()
+
+def get_embedding_index():
+    global _embedding_index
+    if _embedding_index is None:
+        with _embedding_index_lock:
+            if _embedding_index is None:
+                embedding_index = EmbeddingIndex()
+                embedding_index.load()
+                _embedding_index = embedding_index
+    return _embedding_index
+
+
+if __name__ == '__main__':
+    # Report build time, recall@k and latency against brute force:
+    #   cd backend/system && python -m Retrieval.embeddingIndex [--synthetic 50000]
+    parser = argparse.ArgumentParser(description="Benchmark the IVF-PQ index against brute-force search")
+    parser.add_argument('--synthetic', type=int, default=0, help="Use this many random clustered vectors instead of the stored embeddings")
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(64, args.dim))
+        vectors = centers[rng.integers(0, 64, args.synthetic)] + 0.5 * rng.normal(size=(args.synthetic, args.dim))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index = EmbeddingIndex(path=os.path.join(tempfile.mkdtemp(), 'synthetic'))
+        index.add([f"synthetic_{i}" for i in range(args.synthetic)], vectors)
+    else:
+        index = get_embedding_index()
+    if index.size == 0:
+        sys.exit("No embeddings to benchmark")
+    print(json.dumps(benchmark(index, args.queries, args.k), indent=2))
@@ -0,0 +1,261 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+
+class EmbeddingStore:
+    def __init__(self, path, dtype=np.float16):
+        """
+        Append-only on-disk store of fixed-width vectors, read through a memory map.
+        Files (all starting with path):
+          .meta       {"dim", "dtype", "generation"}
+          .<gen>.vec  raw row-major matrix, one row per vector, only ever appended to
+          .<gen>.ids  one JSON line per event: {"row", "filename"} when a row is appended,
+                      {"delete": row} when a row is tombstoned
+        Readers share the pages of the .vec file through the OS page cache, so forked or
+        separate worker processes do not copy the matrix. Replacing or deleting a vector
+        only tombstones its row; compact() writes the next generation without dead rows and
+        switches to it by replacing .meta atomically.
+        :param path: prefix of the store files
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.generation = 0
+        self.lock = threading.RLock()
+
+        self.filenames = []  # row -> filename (None once tombstoned)
+        self.row_of = {}     # filename -> live row
+        self.dead = 0        # Number of tombstoned rows
+        self.size = 0        # Rows in the .vec file
+        self.matrix = None   # Read-only memmap of the first `size` rows
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+            self.generation = meta["generation"]
+            self._load()
+            self._remove_old_generations()
+        else:
+            self._remap()
+
+    @property
+    def vec_path(self):
+        return f"{self.path}.{self.generation}.vec"
+
+    @property
+    def ids_path(self):
+        return f"{self.path}.{self.generation}.ids"
+
+    @property
+    def meta_path(self):
+        return self.path + '.meta'
+
+    @property
+    def row_bytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def _load(self):
+        """
+        Replay the sidecar. Rows written without their sidecar line (interrupted append)
+        are cut off the .vec file.
+        """
+        filenames, row_of, dead = [], {}, 0
+        torn = False
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, 'r') as f:
+                for line in f:
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError("Unterminated line")
+                        event = json.loads(line)
+                    except ValueError:  # Torn last line
+                        torn = True
+                        break
+                    if "delete" in event:
+                        row = event["delete"]
+                        if filenames[row] is not None:
+                            row_of.pop(filenames[row], None)
+                            filenames[row] = None
+                            dead += 1
+                    elif event["filename"] is None:  # Tombstone kept by a rewritten sidecar
+                        filenames.append(None)
+                        dead += 1
+                    else:
+                        filenames.append(event["filename"])
+                        row_of[event["filename"]] = event["row"]
+
+        bytes_on_disk = os.path.getsize(self.vec_path) if os.path.exists(self.vec_path) else 0
+        size = min(bytes_on_disk // self.row_bytes, len(filenames))
+        if bytes_on_disk != size * self.row_bytes:  # Also drops a partially written row
+            with open(self.vec_path, 'r+b') as f:
+                f.truncate(size * self.row_bytes)
+        for row in range(size, len(filenames)):  # Sidecar entries without a vector
+            if filenames[row] is not None and row_of.get(filenames[row]) == row:
+                del row_of[filenames[row]]
+        self.filenames, self.row_of = filenames[:size], row_of
+        self.dead = sum(filename is None for filename in self.filenames)
+        self.size = size
+        if torn or len(filenames) != size:  # Later appends must not continue a torn line
+            self._write_ids(self.ids_path)
+        self._remap()
+
+    def _write_ids(self, ids_path):
+        """
+        Write a sidecar that describes the current rows (tombstones included).
+        """
+        tmp_path = ids_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(json.dumps({"row": row, "filename": filename}) + '\n'
+                            for row, filename in enumerate(self.filenames)))
+        os.replace(tmp_path, ids_path)
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"dim": self.dim, "dtype": self.dtype.name, "generation": self.generation}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _remap(self):
+        if self.size == 0:
+            self.matrix = np.zeros((0, self.dim or 0), dtype=self.dtype)
+        else:
+            self.matrix = np.memmap(self.vec_path, dtype=self.dtype, mode='r', shape=(self.size, self.dim))
+
+    def snapshot(self):
+        """
+        :return: (matrix, filenames, size) for lock-free reads; tombstoned rows have filename None.
+        """
+        with self.lock:
+            return self.matrix, self.filenames, self.size
+
+    def append(self, filenames, vectors):
+        """
+        Append vectors. A filename that is already stored has its old row tombstoned.
+        :return: (new rows, rows that were tombstoned)
+        """
+        filenames = list(filenames)
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._write_meta()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Vector size {vectors.shape[1]} does not match the store ({self.dim})")
+
+            rows, replaced, events = [], [], []
+            latest = {}  # Rows appended by this call, a repeated filename replaces its earlier row
+            for filename in filenames:
+                old = latest.get(filename, self.row_of.get(filename))
+                if old is not None:
+                    replaced.append(old)
+                    events.append({"delete": old})
+                row = self.size + len(rows)
+                rows.append(row)
+                latest[filename] = row
+                events.append({"row": row, "filename": filename})
+
+            # Vectors first: a crash between the two writes leaves rows that _load cuts off
+            with open(self.vec_path, 'ab') as f:
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.ids_path, 'a') as f:
+                f.write(''.join(json.dumps(event) + '\n' for event in events))
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.filenames.extend(filenames)
+            self.row_of.update(latest)
+            for row in replaced:
+                self.filenames[row] = None
+                self.dead += 1
+            self.size += len(rows)
+            self._remap()
+            return rows, replaced
+
+    def delete(self, filenames):
+        """
+        Tombstone the rows of the given filenames.
+        :return: The tombstoned rows.
+        """
+        with self.lock:
+            rows = [self.row_of.pop(filename) for filename in filenames if filename in self.row_of]
+            if rows:
+                with open(self.ids_path, 'a') as f:
+                    f.write(''.join(json.dumps({"delete": row}) + '\n' for row in rows))
+                for row in rows:
+                    self.filenames[row] = None
+                self.dead += len(rows)
+            return rows
+
+    def dead_ratio(self):
+        return self.dead / self.size if self.size else 0.0
+
+    def compact(self, chunk_rows=65536):
+        """
+        Rewrite the store without tombstoned rows (rows are renumbered).
+        The next generation is written next to the current one and becomes current when
+        .meta is replaced, so a crash at any point leaves one complete generation.
+        """
+        self.swap(self.copy_live(chunk_rows))
+
+    def copy_live(self, chunk_rows=65536):
+        """
+        First phase of a compaction, without holding the lock: write the live rows of a
+        snapshot to the next generation's .vec file. Appends and deletes continue meanwhile.
+        :return: State for swap().
+        """
+        with self.lock:
+            matrix, filenames, size = self.matrix, list(self.filenames), self.size
+            generation = self.generation + 1
+        live = [row for row in range(size) if filenames[row] is not None]
+        vec_path = f"{self.path}.{generation}.vec"
+        with open(vec_path, 'wb') as f:
+            for start in range(0, len(live), chunk_rows):
+                f.write(np.ascontiguousarray(matrix[live[start:start + chunk_rows]]).tobytes())
+        return generation, live, size
+
+    def _remove_old_generations(self):
+        """
+        Delete the files of earlier generations. On POSIX memory maps still held by older
+        snapshots keep an unlinked file readable; Windows refuses to delete a mapped file,
+        so such files are left for the next compaction or the next open.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        pattern = re.compile(re.escape(os.path.basename(self.path)) + r'\.(\d+)\.(vec|ids)$')
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match and int(match.group(1)) < self.generation:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:  # Still mapped (Windows) or already gone
+                    pass
+
+    def swap(self, copied):
+        """
+        Second phase of a compaction: append the rows added since copy_live, keep the rows
+        deleted since as tombstones, and switch to the new generation.
+        """
+        generation, live, size = copied
+        with self.lock:
+            added = [row for row in range(size, self.size) if self.filenames[row] is not None]
+            self.generation = generation
+            with open(self.vec_path, 'ab') as f:
+                if added:
+                    f.write(np.ascontiguousarray(self.matrix[added]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.filenames = [self.filenames[row] for row in live + added]
+            self.row_of = {filename: row for row, filename in enumerate(self.filenames) if filename is not None}
+            self.dead = sum(filename is None for filename in self.filenames)
+            self.size = len(self.filenames)
+            self._write_ids(self.ids_path)
+            self._write_meta()
+            self._remap()
+
+            self._remove_old_generations()
+            print(f"Compacted embedding store to {self.size} rows")
@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+import scipy.sparse as sp
+from SQLmethods.connectDB import get_db_manager, BACKEND_DIR
+
+TERM_MATRIX_PATH = os.environ.get('CBIR_TERM_MATRIX', os.path.join(BACKEND_DIR, 'term_matrix'))
+
+# Weights of the vector space model
+QUERY_TERM_WEIGHT = 3.5  # Terms typed by the user
+OTHER_TERM_WEIGHT = 0.75  # Synonyms and every other feature of the image
+
+# (filename, feature value, score) of every image_terms row
+FEATURE_COLUMNS = "images.filename, terms.value, image_terms.score"
+FEATURE_JOIN = ("image_terms JOIN images ON images.id = image_terms.image_id "
+                "JOIN terms ON terms.id = image_terms.term_id")
+
+class TermMatrix:
+    def __init__(self, db_manager, path=TERM_MATRIX_PATH, save_interval=30, merge_rows=1000):
+        """
+        Image x term matrix of feature scores, kept in sync with image_terms.
+        Rows are base filenames, columns are feature values. Stored column-major (CSC), so
+        every column is the posting list (sorted image rows, probabilities) of one term.
+        Changed images go to a small delta segment that overrides their rows in the base
+        matrix; queries score both. The delta is merged into the base on a background thread
+        once it holds merge_rows images, and when the matrix is saved.
+        :param db_manager: DatabaseManager used to (re)load rows
+        :param path: prefix of the .npz matrix and .json dictionary files
+        :param save_interval: minimum number of seconds between two automatic saves
+        :param merge_rows: delta size (images) that triggers a background merge
+        """
+        self.db_manager = db_manager
+        self.path = path
+        self.save_interval = save_interval
+        self.merge_rows = merge_rows
+        self.last_save = 0.0
+        self.lock = threading.RLock()
+        self.maintenance = None  # Background merge / save thread
+        self.save_lock = threading.Lock()  # One save at a time (background and atexit)
+        self.generation = 0  # Incremented by build and load, so a running merge does not install stale data
+
+        self.filenames = []  # row -> filename
+        self.row_of = {}     # filename -> row
+        self.terms = []      # column -> feature value
+        self.col_of = {}     # feature value -> column
+        self.matrix = sp.csc_matrix((0, 0), dtype=np.float64)  # Base segment
+        self.delta_rows = {}  # row -> {column: probability} of changed images (empty dict: no features left)
+        self.delta = sp.csc_matrix((0, 0), dtype=np.float64)  # delta_rows as a matrix, rebuilt when dirty
+        self.overridden = np.zeros(0, dtype=bool)  # Rows whose base entries are superseded by the delta
+        self.sq_norms = np.zeros(0)  # Squared row norms with every term weighted OTHER_TERM_WEIGHT
+        self.delta_dirty = False
+
+    # --- Building and persistence ---
+
+    def data_version(self):
+        """
+        Cheap fingerprint of image_terms, used to detect a stale saved matrix.
+        """
+        count, max_id, total = self.db_manager.fetch_query_results(
+            "SELECT COUNT(*), MAX(rowid), TOTAL(score) FROM image_terms"
+        )[0]
+        return [count, max_id, round(total, 6)]
+
+    def load_or_build(self):
+        if self.load():
+            return
+        self.build()
+        self.save()
+
+    def build(self):
+        """
+        Build the whole matrix from image_terms.
+        """
+        start = time.perf_counter()
+        rows = self.db_manager.fetch_query_results(
+            f"SELECT {FEATURE_COLUMNS} FROM {FEATURE_JOIN} ORDER BY image_terms.rowid"
+        )
+        with self.lock:
+            self.generation += 1
+            self.filenames, self.row_of = [], {}
+            self.terms, self.col_of = [], {}
+            self.delta_rows = {}
+            self._stage_rows(rows, replace=False)
+            self.matrix = self._merged(sp.csc_matrix((0, 0), dtype=np.float64), self.delta_rows,
+                                       len(self.filenames), len(self.terms))
+            self.sq_norms = np.zeros(0)
+            self._build_delta()
+            self.delta_rows = {}
+            self.delta_dirty = True
+        print(f"Built term matrix {self.matrix.shape} with {self.matrix.nnz} entries in {time.perf_counter() - start:.2f}s")
+
+    def save(self):
+        """
+        Merge the delta into the base matrix and write it. The merge and the file writes
+        run outside the lock, so queries are not blocked.
+        """
+        with self.save_lock:
+            version = self.data_version()  # Before the snapshot: a newer database never passes for this file
+            matrix, filenames, terms = self.merge()
+            for suffix in ('.npz', '.json'):
+                if os.path.exists(self.path + suffix + '.tmp'):
+                    os.remove(self.path + suffix + '.tmp')
+            with open(self.path + '.npz.tmp', 'wb') as f:
+                sp.save_npz(f, matrix)
+            with open(self.path + '.json.tmp', 'w') as f:
+                json.dump({"version": version, "filenames": filenames, "terms": terms}, f)
+            os.replace(self.path + '.npz.tmp', self.path + '.npz')
+            os.replace(self.path + '.json.tmp', self.path + '.json')
+        self.last_save = time.time()
+
+    def load(self):
+        """
+        Load the saved matrix if it exists and still matches the database.
+        :return: True if loaded.
+        """
+        if not (os.path.exists(self.path + '.npz') and os.path.exists(self.path + '.json')):
+            return False
+        with open(self.path + '.json', 'r') as f:
+            saved = json.load(f)
+        if saved.get("version") != self.data_version():
+            print("Saved term matrix is out of date, rebuilding")
+            return False
+
+        with self.lock:
+            self.generation += 1
+            self.matrix = sp.load_npz(self.path + '.npz').tocsc()
+            self.filenames = saved["filenames"]
+            self.row_of = {filename: row for row, filename in enumerate(self.filenames)}
+            self.terms = saved["terms"]
+            self.col_of = {term: col for col, term in enumerate(self.terms)}
+            self.sq_norms = np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel() * OTHER_TERM_WEIGHT ** 2
+            self.delta_rows = {}
+            self.delta_dirty = True
+            self.last_save = time.time()
+        return True
+
+    def maybe_save(self):
+        """Save on a background thread if save_interval has passed since the last save."""
+        if time.time() - self.last_save >= self.save_interval:
+            self._start_maintenance(self.save)
+
+    # --- Incremental maintenance ---
+
+    def _stage_rows(self, rows, replace=True):
+        """
+        Stage (filename, feature_value, probability) rows in the delta. With replace=True the
+        staged rows become the complete feature set of their images.
+        """
+        for filename, feature_value, probability in rows:
+            filename = os.path.basename(filename)
+            row = self.row_of.get(filename)
+            if row is None:
+                row = len(self.filenames)
+                self.filenames.append(filename)
+                self.row_of[filename] = row
+            if replace and row not in self.delta_rows:
+                self.delta_rows[row] = {}
+            col = self.col_of.get(feature_value)
+            if col is None:
+                col = len(self.terms)
+                self.terms.append(feature_value)
+                self.col_of[feature_value] = col
+            # The first value of a repeated (image, feature) pair wins
+            self.delta_rows.setdefault(row, {}).setdefault(col, float(probability))
+        self.delta_dirty = True
+
+    def _build_delta(self):
+        """
+        Rebuild the delta matrix, the override mask and the row norms from delta_rows.
+        Costs O(delta + rows); the base matrix is not touched. New arrays are built so that
+        earlier snapshots stay valid.
+        """
+        n_rows, n_cols = len(self.filenames), len(self.terms)
+        r, c, v = [], [], []
+        for row, values in self.delta_rows.items():
+            r.extend([row] * len(values))
+            c.extend(values.keys())
+            v.extend(values.values())
+        delta = sp.csc_matrix((v, (r, c)), shape=(n_rows, n_cols), dtype=np.float64)
+        delta.sort_indices()
+
+        sq_norms = np.zeros(n_rows)
+        sq_norms[:len(self.sq_norms)] = self.sq_norms
+        overridden = np.zeros(n_rows, dtype=bool)
+        for row, values in self.delta_rows.items():
+            sq_norms[row] = sum(value * value for value in values.values()) * OTHER_TERM_WEIGHT ** 2
+            overridden[row] = True
+        self.delta, self.overridden, self.sq_norms = delta, overridden, sq_norms
+        self.delta_dirty = False
+
+    @staticmethod
+    def _merged(base, delta_rows, n_rows, n_cols):
+        """
+        New base matrix of shape (n_rows, n_cols): base with the rows in delta_rows replaced.
+        Costs O(entries of the whole matrix).
+        """
+        # Grow the base matrix to the new shape (new rows and columns are empty)
+        indptr = np.concatenate([base.indptr, np.full(n_cols - base.shape[1], base.indptr[-1], dtype=base.indptr.dtype)])
+        base = sp.csc_matrix((base.data, base.indices, indptr), shape=(n_rows, n_cols))
+
+        keep = np.ones(n_rows)
+        keep[list(delta_rows)] = 0.0
+        kept = sp.diags(keep) @ base
+        kept.eliminate_zeros()
+
+        r, c, v = [], [], []
+        for row, values in delta_rows.items():
+            r.extend([row] * len(values))
+            c.extend(values.keys())
+            v.extend(values.values())
+        staged = sp.csc_matrix((v, (r, c)), shape=(n_rows, n_cols), dtype=np.float64)
+        merged = (kept + staged).tocsc()
+        merged.sort_indices()  # Posting lists ordered by image row
+        return merged
+
+    def merge(self):
+        """
+        Fold the current delta into the base matrix. Rows staged again while merging stay
+        in the delta (they override the merged rows).
+        :return: (merged base matrix, its filenames, its terms)
+        """
+        with self.lock:
+            if self.delta_dirty:
+                self._build_delta()  # sq_norms must hold the norms of the rows that move to the base
+            generation = self.generation
+            base = self.matrix
+            delta_rows = dict(self.delta_rows)  # Staging replaces a row's dict, so these stay unchanged
+            filenames, terms = list(self.filenames), list(self.terms)
+        merged = self._merged(base, delta_rows, len(filenames), len(terms))
+        with self.lock:
+            if generation == self.generation:
+                self.matrix = merged
+                for row, values in delta_rows.items():
+                    if self.delta_rows.get(row) is values:
+                        del self.delta_rows[row]
+                self.delta_dirty = True
+        return merged, filenames, terms
+
+    def _start_maintenance(self, target):
+        with self.lock:
+            if self.maintenance is not None and self.maintenance.is_alive():
+                return  # The running merge or save folds in the delta anyway
+            if target == self.save:
+                self.last_save = time.time()
+            self.maintenance = threading.Thread(target=self._run_maintenance, args=(target,), daemon=True)
+            self.maintenance.start()
+
+    @staticmethod
+    def _run_maintenance(target):
+        try:
+            target()
+        except Exception as e:
+            print(f"Error maintaining the term matrix: {e}")
+
+    def refresh_images(self, filenames):
+        """
+        Reload the features of the given images from the database (after inserts or updates).
+        """
+        filenames = list({os.path.basename(filename) for filename in filenames})
+        if not filenames:
+            return
+        placeholders = ', '.join(['?'] * len(filenames))
+        rows = self.db_manager.fetch_query_results(
+            f"SELECT {FEATURE_COLUMNS} FROM {FEATURE_JOIN} WHERE images.filename IN ({placeholders}) ORDER BY image_terms.rowid",
+            tuple(filenames)
+        )
+        with self.lock:
+            for filename in filenames:  # Images without rows left lose all their features
+                if filename in self.row_of:
+                    self.delta_rows[self.row_of[filename]] = {}
+            self._stage_rows(rows)
+            large_delta = len(self.delta_rows) >= self.merge_rows
+        if large_delta:
+            self._start_maintenance(self.merge)
+
+    def snapshot(self):
+        """
+        Consistent view for lock-free reads. Only the delta is rebuilt, never the base matrix.
+        :return: (base matrix, delta matrix, overridden rows mask, squared row norms, filenames, col_of)
+        """
+        with self.lock:
+            if self.delta_dirty:
+                self._build_delta()
+            return self.matrix, self.delta, self.overridden, self.sq_norms, self.filenames, self.col_of
+
+    # --- Scoring ---
+
+    def query_weights(self, included_words, all_query_terms, n_cols=None):
+        """
+        :param n_cols: Ignore columns added after a snapshot with this many columns was taken.
+        :return: (columns, weights) of the query terms that exist in the matrix.
+        """
+        included = set(included_words)
+        cols, weights = [], []
+        for term in all_query_terms:
+            col = self.col_of.get(term)
+            if col is not None and (n_cols is None or col < n_cols):
+                cols.append(col)
+                weights.append(QUERY_TERM_WEIGHT if term in included else OTHER_TERM_WEIGHT)
+        return np.array(cols, dtype=np.int64), np.array(weights)
+
+    def score(self, included_words, all_query_terms):
+        """
+        Cosine similarity between the weighted query and every image that has at least one query term.
+        Image vectors weight query words 3.5 and every other feature 0.75, like the query vector.
+        :return: (filenames, scores), in row order.
+        """
+        base, delta, overridden, sq_norms, filenames, _ = self.snapshot()
+        cols, weights = self.query_weights(included_words, all_query_terms, delta.shape[1])
+        if len(cols) == 0:
+            return [], np.zeros(0)
+
+        # Every image is scored from exactly one segment: the delta if it changed, the base otherwise
+        base_rows, base_dots, base_sq = self._score_segment(base, cols, weights, sq_norms, overridden)
+        delta_rows, delta_dots, delta_sq = self._score_segment(delta, cols, weights, sq_norms)
+        rows = np.concatenate([base_rows, delta_rows])
+        if len(rows) == 0:
+            return [], np.zeros(0)
+        order = np.argsort(rows, kind='stable')
+        rows = rows[order]
+        dots = np.concatenate([base_dots, delta_dots])[order]
+        row_sq_norms = np.concatenate([base_sq, delta_sq])[order]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(row_sq_norms > 0, dots / (np.sqrt(row_sq_norms) * np.linalg.norm(weights)), 0.0)
+        return [filenames[row] for row in rows], scores
+
+    @staticmethod
+    def _score_segment(segment, cols, weights, sq_norms, excluded=None):
+        """
+        Query dot products and squared norms of the images with query terms in one segment.
+        :param excluded: Mask of rows to leave out (base rows overridden by the delta)
+        :return: (rows, dots, squared norms)
+        """
+        in_segment = cols < segment.shape[1]  # The base may predate the newest terms
+        cols, weights = cols[in_segment], weights[in_segment]
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+        if len(cols) == 0:
+            return empty
+        sub = segment[:, cols].tocsr()  # Sparse dot product over the query's posting lists only
+        candidates = np.flatnonzero(np.diff(sub.indptr))
+        if excluded is not None:
+            candidates = candidates[~excluded[candidates]]
+        if len(candidates) == 0:
+            return empty
+        sub = sub[candidates]
+
+        # Query words weigh 3.5 instead of 0.75 in the image vector, correct the precomputed norm
+        boost = np.where(weights == QUERY_TERM_WEIGHT, QUERY_TERM_WEIGHT ** 2 - OTHER_TERM_WEIGHT ** 2, 0.0)
+        return candidates, sub @ (weights * weights), sq_norms[candidates] + sub.multiply(sub) @ boost
+
+    def top_k(self, included_words, all_query_terms, k):
+        """
+        The k images with the highest score, best first (ties in row order).
+        Scores every candidate with score() and only sorts the k best (argpartition).
+        :return: List of (filename, score).
+        """
+        filenames, scores = self.score(included_words, all_query_terms)
+        if k <= 0 or len(scores) == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        best = best[np.lexsort((best, -scores[best]))]
+        return [(filenames[i], float(scores[i])) for i in best]
+
+
+# One term matrix per process
+_term_matrix = None
+_term_matrix_lock = threading.Lock()
+
+def get_term_matrix():
+    global _term_matrix
+    if _term_matrix is None:
+        with _term_matrix_lock:
+            if _term_matrix is None:
+                term_matrix = TermMatrix(get_db_manager())
+                term_matrix.load_or_build()
+                _term_matrix = term_matrix
+    return _term_matrix
@@ -1,54 +1,445 @@
 import sqlite3
 import threading
-import pandas as pd
+import queue
+import os
+from contextlib import contextmanager
+
+# backend/ folder, where database.db and dbcmd.sql live
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+DB_PATH = os.environ.get('CBIR_DB_PATH', os.path.join(BACKEND_DIR, 'database.db'))
+SQL_SCRIPT_PATH = os.path.join(BACKEND_DIR, 'dbcmd.sql')
+
+# Feature type of keywords taken from user sentences, kept when an image is re-analysed
+USER_FEEDBACK_TYPE = 'User sentence feedback'
+
+class ConnectionPool:
+    def __init__(self, db_path, max_connections=8):
+        """
+        Reuse a bounded set of read-only sqlite connections across threads.
+        A connection is only ever used by the thread that checked it out.
+        :param db_path: path to the sqlite database
+        :param max_connections: connections opened at most; further callers wait for a free one
+        """
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.idle = queue.LifoQueue()  # Most recently used first, keeps few connections hot
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA query_only = ON")  # Writes go through DatabaseManager.transaction()
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.max_connections:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return self.idle.get()  # Wait for another thread to give one back
+
+    def release(self, conn):
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.created -= 1
+
 
 class DatabaseManager:
-    def __init__(self, db_path):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self.lock = threading.Lock()  # Create a lock for thread safety
+    def __init__(self, db_path=DB_PATH, sql_script_path=SQL_SCRIPT_PATH, max_connections=8):
+        """
+        SQLite in WAL mode: pooled connections serve reads concurrently while a single
+        writer connection applies writes one transaction at a time, so readers never
+        wait for an ingest batch to commit.
+        """
+        self.db_path = db_path
+        self.sql_script_path = sql_script_path
+
+        # One writer connection; isolation_level=None so transactions are explicit
+        self.writer = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.writer.execute("PRAGMA journal_mode = WAL")
+        self.writer.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, fsync only at checkpoints
+        self.writer.execute("PRAGMA foreign_keys = ON")  # Deleting an image deletes its terms and metadata
+        self.lock = threading.RLock()  # Writers queue here, one transaction at a time
+        self.local = threading.local()
+
+        self.pool = ConnectionPool(db_path, max_connections)
         self.execute_sql_script()
+        self.migrate_legacy_features()
+        self.migrate_ingest_tasks()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run several statements in one write transaction:
+
+            with db_manager.transaction() as conn:
+                conn.execute(...)
+                conn.executemany(...)
+
+        Commits on success and rolls back on error. Nested calls join the outer transaction.
+        """
+        with self.lock:
+            if getattr(self.local, 'in_transaction', False):
+                yield self.writer
+                return
+
+            self.writer.execute("BEGIN IMMEDIATE")
+            self.local.in_transaction = True
+            try:
+                yield self.writer
+                self.writer.execute("COMMIT")
+            except BaseException:
+                self.writer.execute("ROLLBACK")
+                raise
+            finally:
+                self.local.in_transaction = False
 
     def execute_query(self, query, params=()):
-        with self.lock:  # Acquire the lock before executing the query
-            self.cursor.execute(query, params)
-            self.conn.commit()
+        """
+        Execute one write statement; commits immediately unless called inside transaction().
+        """
+        with self.transaction() as conn:
+            conn.execute(query, params)
+
+    def execute_many(self, query, rows):
+        """
+        Execute one prepared statement for every row inside a single transaction.
+        :return: Number of rows written.
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self.transaction() as conn:  # All or nothing
+            conn.executemany(query, rows)
+        return len(rows)
+
+    def _ids(self, conn, table, column, values, chunk_size=500, add=True):
+        """
+        Ids of the given values of a (id, unique column) table, adding the missing ones.
+        Must run inside transaction(), on its connection.
+        :param add: With add=False missing values are left out instead of added
+        :return: Dict of value -> id
+        """
+        values = list(set(values))
+        if add:
+            conn.executemany(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", [(value,) for value in values])
+        ids = {}
+        for start in range(0, len(values), chunk_size):  # Stay below SQLite's bound parameter limit
+            chunk = values[start:start + chunk_size]
+            placeholders = ', '.join(['?'] * len(chunk))
+            ids.update((value, id_) for id_, value in conn.execute(
+                f"SELECT id, {column} FROM {table} WHERE {column} IN ({placeholders})", chunk))
+        return ids
+
+    def insert_features(self, rows):
+        """
+        Bulk insert (filename, feature_type, feature_value, region, score) rows into image_terms.
+        Feature values are interned in terms. Rows of filenames missing from images are skipped
+        (images are added by register_images). Rows must already be validated.
+        :return: Number of rows written.
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self.transaction() as conn:
+            image_ids = self._ids(conn, "images", "filename", (row[0] for row in rows), add=False)
+            rows = [row for row in rows if row[0] in image_ids]
+            term_ids = self._ids(conn, "terms", "value", (row[2] for row in rows))
+            conn.executemany(
+                "INSERT INTO image_terms (image_id, term_id, feature_type, region, score) VALUES (?, ?, ?, ?, ?)",
+                [(image_ids[filename], term_ids[value], feature_type, region, score)
+                 for filename, feature_type, value, region, score in rows]
+            )
+        return len(rows)
+
+    def insert_metadata(self, rows):
+        """
+        Add or replace (filename, name, value_text, value_real, value_blob) rows in image_metadata.
+        Rows of filenames missing from images are skipped.
+        :return: Number of rows written.
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self.transaction() as conn:
+            image_ids = self._ids(conn, "images", "filename", (row[0] for row in rows), add=False)
+            rows = [row for row in rows if row[0] in image_ids]
+            conn.executemany(
+                "INSERT OR REPLACE INTO image_metadata (image_id, name, value_text, value_real, value_blob) VALUES (?, ?, ?, ?, ?)",
+                [(image_ids[filename], *values) for filename, *values in rows]
+            )
+        return len(rows)
+
+    def register_images(self, rows):
+        """
+        Add or update (filename, content_hash, file_size, width, height) rows in the images table.
+        An existing filename keeps its id, and with it its position in listings.
+        """
+        return self.execute_many(
+            """
+            INSERT INTO images (filename, content_hash, file_size, width, height) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET
+                content_hash = excluded.content_hash,
+                file_size = excluded.file_size,
+                width = excluded.width,
+                height = excluded.height
+            """,
+            rows
+        )
+
+    def find_images_by_hash(self, content_hash):
+        """
+        :return: List of (id, filename) of the images whose file has this content hash.
+        """
+        return self.fetch_query_results(
+            "SELECT id, filename FROM images WHERE content_hash = ? ORDER BY id", (content_hash,)
+        )
+
+    def delete_image_features(self, filenames, keep_types=(USER_FEEDBACK_TYPE,)):
+        """
+        Delete the analysed features and metadata of images before they are written again.
+        Features of the types in keep_types (user feedback by default) are kept.
+        """
+        filenames = list(filenames)
+        if not filenames:
+            return
+        placeholders = ', '.join(['?'] * len(filenames))
+        keep_placeholders = ', '.join(['?'] * len(keep_types))
+        image_ids = f"SELECT id FROM images WHERE filename IN ({placeholders})"
+        with self.transaction() as conn:
+            conn.execute(
+                f"DELETE FROM image_terms WHERE image_id IN ({image_ids}) AND feature_type NOT IN ({keep_placeholders})",
+                (*filenames, *keep_types)
+            )
+            conn.execute(f"DELETE FROM image_metadata WHERE image_id IN ({image_ids})", filenames)
+
+    def copy_image(self, source, target):
+        """
+        Give target the image row values, features and metadata of source (same file content
+        under another name), replacing what target had. Nothing is analysed again.
+        """
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT id, content_hash, file_size, width, height FROM images WHERE filename = ?", (source,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(source)
+            source_id, *values = row
+            self.register_images([(target, *values)])
+            target_id = conn.execute("SELECT id FROM images WHERE filename = ?", (target,)).fetchone()[0]
+            self.delete_image_features([target])
+            conn.execute(
+                """
+                INSERT INTO image_terms (image_id, term_id, feature_type, region, score)
+                SELECT ?, term_id, feature_type, region, score FROM image_terms
+                WHERE image_id = ? AND feature_type != ? ORDER BY rowid
+                """,
+                (target_id, source_id, USER_FEEDBACK_TYPE)
+            )
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO image_metadata (image_id, name, value_text, value_real, value_blob)
+                SELECT ?, name, value_text, value_real, value_blob FROM image_metadata WHERE image_id = ?
+                """,
+                (target_id, source_id)
+            )
+            conn.execute(
+                "UPDATE image_metadata SET value_text = ? WHERE image_id = ? AND name = 'File Name'",
+                (target, target_id)
+            )
+
+    def rename_image(self, source, target):
+        """
+        Move the image row of source (with its id, features and metadata) to the name target.
+        An older image stored under target is deleted.
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM images WHERE filename = ?", (target,))  # Cascades to its rows
+            conn.execute("UPDATE images SET filename = ? WHERE filename = ?", (target, source))
+            conn.execute(
+                "UPDATE image_metadata SET value_text = ? WHERE name = 'File Name' "
+                "AND image_id = (SELECT id FROM images WHERE filename = ?)",
+                (target, target)
+            )
+
+    def get_image_id(self, filename):
+        """
+        :return: id of filename in the images table, or None.
+        """
+        rows = self.fetch_query_results("SELECT id FROM images WHERE filename = ?", (filename,))
+        return rows[0][0] if rows else None
+
+    def get_content_hash(self, filename):
+        """
+        :return: (content_hash, file_size) recorded for filename in the images table, or None.
+        """
+        rows = self.fetch_query_results("SELECT content_hash, file_size FROM images WHERE filename = ?", (filename,))
+        return rows[0] if rows else None
+
+    def get_term_ids(self, values, conn=None):
+        """
+        Ids of the given feature values that exist in terms (unknown values are left out).
+        :param conn: Connection to read with, e.g. the one of an open transaction()
+        :return: Dict of value -> id
+        """
+        values = list(set(values))
+        if not values:
+            return {}
+        placeholders = ', '.join(['?'] * len(values))
+        query = f"SELECT id, value FROM terms WHERE value IN ({placeholders})"
+        if conn is not None:
+            rows = conn.execute(query, values).fetchall()
+        else:
+            rows = self.fetch_query_results(query, tuple(values))
+        return {value: id_ for id_, value in rows}
+
+    def list_images(self, cursor=0, limit=100):
+        """
+        One page of the images table in id order.
+        :param cursor: Return images with an id greater than this (0 for the first page)
+        :return: List of (id, filename)
+        """
+        return self.fetch_query_results(
+            "SELECT id, filename FROM images WHERE id > ? ORDER BY id LIMIT ?",
+            (cursor, limit)
+        )
 
     def fetch_query_results(self, query, params=()):
-        with self.lock:  # Acquire the lock before executing the query
-            self.cursor.execute(query, params)  # Pass params to execute
-            return self.cursor.fetchall()  # Fetch and return all results
+        with self.pool.connection() as conn:
+            return conn.execute(query, params).fetchall()  # Fetch and return all results
+
+    def migrate_ingest_tasks(self):
+        """
+        Add the content_hash column to an ingest_tasks table created before it existed.
+        """
+        with self.lock:
+            columns = {row[1] for row in self.writer.execute("PRAGMA table_info(ingest_tasks)")}
+            if 'content_hash' not in columns:
+                self.writer.execute("ALTER TABLE ingest_tasks ADD COLUMN content_hash TEXT")
+
+    def migrate_legacy_features(self):
+        """
+        Move the rows of the old flat Imagefeatures table (filename string, free-text value and
+        a probability that also held metadata values on every row) into images, terms,
+        image_terms and image_metadata, then drop it. Runs once, in one transaction.
+        """
+        with self.lock:
+            legacy = self.writer.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Imagefeatures'"
+            ).fetchone()
+            if not legacy:
+                return
+
+            with self.transaction() as conn:
+                count = conn.execute("SELECT COUNT(*) FROM Imagefeatures").fetchone()[0]
+                conn.execute("INSERT OR IGNORE INTO images (filename) SELECT DISTINCT filename FROM Imagefeatures")
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO terms (value)
+                    SELECT DISTINCT feature_value FROM Imagefeatures
+                    WHERE feature_type NOT IN ('Metadata', 'Error') AND feature_value IS NOT NULL
+                    """
+                )
+                conn.execute(
+                    """
+                    INSERT INTO image_terms (image_id, term_id, feature_type, region, score)
+                    SELECT images.id, terms.id, f.feature_type, 'Original', f.probability
+                    FROM Imagefeatures f
+                    JOIN images ON images.filename = f.filename
+                    JOIN terms ON terms.value = f.feature_value
+                    WHERE f.feature_type NOT IN ('Metadata', 'Error') AND f.probability IS NOT NULL
+                    ORDER BY f.id
+                    """
+                )
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO image_metadata (image_id, name, value_text, value_real)
+                    SELECT images.id, f.feature_value,
+                           CASE WHEN typeof(f.probability) IN ('integer', 'real') THEN NULL ELSE f.probability END,
+                           CASE WHEN typeof(f.probability) IN ('integer', 'real') THEN f.probability END
+                    FROM Imagefeatures f
+                    JOIN images ON images.filename = f.filename
+                    WHERE f.feature_type IN ('Metadata', 'Error') AND f.feature_value IS NOT NULL
+                    ORDER BY f.id
+                    """
+                )
+                for column, name in (("width", "Image Width"), ("height", "Image Height")):
+                    conn.execute(
+                        f"""
+                        UPDATE images SET {column} = (
+                            SELECT CAST(value_real AS INTEGER) FROM image_metadata
+                            WHERE image_metadata.image_id = images.id AND image_metadata.name = ?
+                        ) WHERE {column} IS NULL
+                        """,
+                        (name,)
+                    )
+                conn.execute("DROP TABLE Imagefeatures")
+            self.writer.execute("VACUUM")  # Give the space of the old table and its indexes back
+        print(f"Migrated {count} Imagefeatures rows to the normalized schema")
 
     def close(self):
-        self.cursor.close()
-        self.conn.close()
-    
+        self.pool.close_all()
+        with self.lock:
+            self.writer.close()
+
     def execute_sql_script(self):
-        # Paths
-        database_path = r"D:\Github Local Repos\CBIR\backend\database.db" # your path
-        sql_file_path = r"D:\Github Local Repos\CBIR\backend\dbcmd.sql" # your path
-        # Connect to the SQLite database
-        conn = sqlite3.connect(database_path)
-        cursor = conn.cursor()
-
-        # Read and execute the SQL script
-        with open(sql_file_path, 'r') as file:
+        """
+        Create the schema from dbcmd.sql. Runs once, when the manager is created.
+        """
+        with open(self.sql_script_path, 'r') as file:
             sql_script = file.read()
-        
-        # Execute the SQL commands in the script
-        cursor.executescript(sql_script)
-        
-        # Commit changes and close the connection
-        conn.commit()
-        cursor.close()
-        conn.close()
+
+        with self.lock:
+            self.writer.executescript(sql_script)
         print("SQL script executed successfully.")
 
-# Usage
-def ConnectDB():
-    db_manager = DatabaseManager('../database.db')
-    return db_manager.cursor, db_manager.conn
+
+# One initialised manager per process
+_db_manager = None
+_db_manager_lock = threading.Lock()
 
 def get_db_manager():
-    db_manager = DatabaseManager('../database.db')
-    return db_manager
\ No newline at end of file
+    global _db_manager
+    if _db_manager is None:
+        with _db_manager_lock:
+            if _db_manager is None:
+                _db_manager = DatabaseManager()
+    return _db_manager
+
+# Usage
+def ConnectDB():
+    """
+    Return a dedicated (cursor, connection) pair on the configured database.
+    Prefer get_db_manager(), which shares pooled connections.
+    """
+    conn = sqlite3.connect(get_db_manager().db_path, check_same_thread=False)
+    return conn.cursor(), conn
@@ -1,95 +1,362 @@
 # --- START OF FILE ImageProcessorManager.py --- (Corrected)
 
 import os
+import queue
 import threading
-from PIL import Image
+import time
+import numbers
+import json
+from ThreadPool.threads import ThreadPool
+from utils.thumbnailCache import file_hash
+from utils.imageContext import ImageContext
+from methods.modelRegistry import limit_torch_threads
+
+def extract_features(extractor, filepaths, image_contexts):
+    """
+    CNN stage of a group of images in one forward pass. If the batch fails, each image is
+    run on its own, so only the images that fail by themselves get an exception.
+    :return: One entry per filepath: (features, embedding), or the exception.
+    """
+    try:
+        features, embeddings = extractor.get_features_batch(
+            filepaths, batch_size=len(filepaths), image_contexts=image_contexts, return_embeddings=True)
+        return list(zip(features, embeddings))
+    except Exception as e:
+        if len(filepaths) == 1:
+            return [e]
+    outcomes = []
+    for filepath, image_context in zip(filepaths, image_contexts):
+        try:
+            features, embeddings = extractor.get_features_batch(
+                [filepath], batch_size=1, image_contexts=[image_context], return_embeddings=True)
+            outcomes.append((features[0], embeddings[0]))
+        except Exception as e:
+            outcomes.append(e)
+    return outcomes
+
+def analyze_images(filepaths, ImageColorAnalyzer, GetMetadata, ImageFeatureExtractor, process_top_features, thumbnail_cache=None, torch_threads=None,
+                   content_hashes=None):
+    """
+    Run the color, metadata and CNN stages for a group of images, and write their thumbnails.
+    Each file is decoded once and every stage reads the same pixel buffer; the CNN stage runs
+    one forward pass over all images of the group (5 crops each).
+    Kept at module level so process workers can pickle it; the model is shared per process.
+    :param torch_threads: Intra-op threads of the worker process (see limit_torch_threads)
+    :param content_hashes: Known content hash per filepath (e.g. computed while the upload was
+                           spooled), or None for files that have to be hashed
+    :return: One entry per filepath: (res1, res2, res3, info), or the exception if the image failed.
+    """
+    limit_torch_threads(torch_threads)
+    outcomes = [None] * len(filepaths)
+    prepared = []  # (index, ImageContext, res1, res2, info)
+    content_hashes = content_hashes or [None] * len(filepaths)
+    for index, filepath in enumerate(filepaths):
+        try:
+            image_context = ImageContext(filepath)
+            res1 = ImageColorAnalyzer(filepath, image_context=image_context).full_color_analysis()
+            res2 = GetMetadata(filepath, image_context=image_context)
+            info = {"content_hash": content_hashes[index], "file_size": os.path.getsize(filepath)}
+            if thumbnail_cache is not None:
+                try:
+                    info["content_hash"] = thumbnail_cache.create_thumbnails(filepath, image_context=image_context,
+                                                                             digest=info["content_hash"])
+                except Exception as e:  # Thumbnails are rebuilt on demand, do not lose the features
+                    print(f"Error creating thumbnails for {filepath}: {e}")
+            if info["content_hash"] is None:
+                info["content_hash"] = file_hash(filepath)
+            prepared.append((index, image_context, res1, res2, info))
+        except Exception as e:
+            outcomes[index] = e
+
+    if prepared:
+        extracted = extract_features(ImageFeatureExtractor(process_top_features),
+                                     [filepaths[item[0]] for item in prepared], [item[1] for item in prepared])
+        for (index, _, res1, res2, info), result in zip(prepared, extracted):
+            if isinstance(result, Exception):
+                outcomes[index] = result
+                continue
+            res3, info["embedding"] = result
+            outcomes[index] = (res1, res2, res3, info)
+    return outcomes
+
+def to_probability(value):
+    """
+    Return value as a float if it is numeric (or a numeric string), otherwise None.
+    """
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+def build_image_row(base_filename, metadata, info):
+    """
+    Row for the images table: (filename, content_hash, file_size, width, height).
+    """
+    dimensions = {item['feature_value']: item['probability'] for item in metadata
+                  if item.get('feature_value') in ("Image Width", "Image Height")}
+    return (base_filename, info.get("content_hash"), info.get("file_size"),
+            dimensions.get("Image Width"), dimensions.get("Image Height"))
+
+def typed_metadata_value(value):
+    """
+    Split a metadata value into the (value_text, value_real, value_blob) columns of image_metadata.
+    Numbers go to value_real, bytes (e.g. ICC profiles) to value_blob, strings to value_text
+    and structured values (GPS dicts, tuples) to value_text as JSON.
+    """
+    if value is None or value == "":
+        return None, None, None
+    if isinstance(value, (bytes, bytearray)):
+        return None, None, bytes(value)
+    if isinstance(value, numbers.Real):
+        return None, float(value), None
+    if isinstance(value, str):
+        return value, None, None
+    return json.dumps(value, default=str), None, None
+
+def build_metadata_rows(base_filename, metadata):
+    """
+    Turn GetMetadata output into image_metadata rows (filename, name, value_text, value_real, value_blob).
+    """
+    return [(base_filename, str(item['feature_value']), *typed_metadata_value(item.get('probability')))
+            for item in metadata if item.get('feature_value')]
+
+def build_feature_rows(base_filename, *feature_lists):
+    """
+    Validate feature dicts and turn them into image_terms rows
+    (filename, feature_type, feature_value, region, score).
+    Items whose probability is not numeric are skipped, and only the first score of a
+    repeated (feature_type, feature_value, region) is kept.
+    :return: (rows, number of skipped items)
+    """
+    rows = []
+    seen = set()
+    skipped = 0
+    for items in feature_lists:
+        for item in items:
+            probability = to_probability(item.get('probability'))
+            if probability is None or not item.get('feature_type'):
+                skipped += 1
+                continue
+            key = (item['feature_type'], str(item['feature_value']), item.get('region', "Original"))
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append((base_filename, *key, probability))
+    return rows, skipped
+
+def write_results(db_manager, results):
+    """
+    Write analysed images in one transaction: their images rows, their features (replacing
+    the analysed rows of re-analysed images) and their metadata.
+    Used by the ingestion writer and by the bulk indexer.
+    :param results: (base_filename, res1, res2, res3, info) per image
+    :return: Number of feature rows written.
+    """
+    rows = []
+    metadata_rows = []
+    images = []
+    for base_filename, res1, res2, res3, info in results:
+        if not base_filename:  # Skip if base_filename is empty
+            continue
+        image_rows, skipped = build_feature_rows(base_filename, res1, res3)
+        if skipped:
+            print(f"Skipped {skipped} non-numeric feature(s) for {base_filename}")
+        rows.extend(image_rows)
+        metadata_rows.extend(build_metadata_rows(base_filename, res2))
+        images.append(build_image_row(base_filename, res2, info))
+
+    with db_manager.transaction():  # Image index, features and metadata commit together
+        db_manager.register_images(images)
+        db_manager.delete_image_features(image[0] for image in images)  # Re-analysed images replace their rows
+        written = db_manager.insert_features(rows)
+        db_manager.insert_metadata(metadata_rows)
+    return written
+
+def notify(on_complete, base_filename, error):
+    """
+    Call a completion callback; its own errors must not stop the workers or the writer.
+    """
+    if on_complete is None:
+        return
+    try:
+        on_complete(base_filename, error)
+    except Exception as e:
+        print(f"Error in completion callback for {base_filename}: {e}")
 
 class ImageProcessingManager:
-    def __init__(self, upload_folder, ImageColorAnalyzer, GetMetadata, ImageFeatureExtractor, process_top_features, cursor, conn):
+    def __init__(self, upload_folder, ImageColorAnalyzer, GetMetadata, ImageFeatureExtractor, process_top_features, db_manager,
+                 term_matrix=None, thumbnail_cache=None, embedding_index=None, max_workers=None, max_queue=None, executor_kind='thread', commit_batch_size=8, max_pending_writes=64,
+                 inference_batch_size=8, batch_wait=0.05):
+        """
+        :param inference_batch_size: Images analysed together by one worker, in one forward pass
+        :param batch_wait: Seconds a partial group waits for more images before it is submitted
+        """
         self.upload_folder = upload_folder
         self.ImageColorAnalyzer = ImageColorAnalyzer
         self.GetMetadata = GetMetadata
         self.ImageFeatureExtractor = ImageFeatureExtractor
         self.process_top_features = process_top_features
-        self.cursor = cursor
-        self.conn = conn
-        self.results = []
-        self.lock = threading.Lock()
-        self.threads = []
+        self.db_manager = db_manager
+        self.term_matrix = term_matrix  # Kept in sync with every commit when given
+        self.thumbnail_cache = thumbnail_cache
+        self.embedding_index = embedding_index  # Receives the pooled embedding of every image when given
+        # Fixed number of workers, each analysing a group of up to inference_batch_size images
+        self.pool = ThreadPool(max_threads=max_workers, max_queue=max_queue, kind=executor_kind)
+        # Workers share the cores: thread workers share this process' torch thread pool,
+        # process workers set their own limit in analyze_images
+        self.torch_threads = max(1, (os.cpu_count() or 1) // self.pool.max_threads)
+        if executor_kind == 'thread':
+            limit_torch_threads(self.torch_threads)
+
+        # Finished images wait in write_queue for the writer. Result callbacks must not block
+        # (in process mode they run on the executor's only result thread), so the queue itself is
+        # unbounded and process_image takes a slot per image instead, given back once it is written.
+        self.commit_batch_size = commit_batch_size
+        self.write_queue = queue.Queue()
+        self.inference_batch_size = inference_batch_size
+        self.batch_wait = batch_wait
+        self.write_slots = threading.BoundedSemaphore(
+            max_pending_writes + (self.pool.max_threads + self.pool.max_queue) * inference_batch_size)
+        # Images waiting to be grouped; process_image blocks once a full group per queue slot is waiting
+        self.intake = queue.Queue(maxsize=self.pool.max_queue * inference_batch_size)
+        self.batcher = threading.Thread(target=self.batch_loop, daemon=True)
+        self.batcher.start()
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
 
-    def process_image(self, base_filename):
+    def process_image(self, base_filename, on_complete=None, content_hash=None):
+        """
+        Analyse one stored image and write its features.
+        :param on_complete: Optional on_complete(base_filename, error), called once the image is
+                            committed (error None) or has failed (the exception)
+        :param content_hash: SHA-1 of the file if already known, so it is not hashed again
+        """
         filepath = os.path.join(self.upload_folder, base_filename)
-        thread = threading.Thread(target=self.image_processing_thread, args=(filepath, base_filename)) # Pass base_filename
-        self.threads.append(thread)
-        thread.start()
+        self.write_slots.acquire()  # Blocks while the writer is max_pending_writes images behind
+        self.intake.put((filepath, base_filename, on_complete, content_hash))
+
+    def batch_loop(self):
+        """
+        Group waiting images (up to inference_batch_size, waiting at most batch_wait for a group
+        to fill) and submit each group as one task.
+        """
+        while True:
+            group = [self.intake.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(group) < self.inference_batch_size:
+                try:
+                    group.append(self.intake.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.pool.add_thread(  # Blocks while the pool and its queue are full
+                    analyze_images,
+                    args=([item[0] for item in group], self.ImageColorAnalyzer, self.GetMetadata,
+                          self.ImageFeatureExtractor, self.process_top_features, self.thumbnail_cache, self.torch_threads,
+                          [item[3] for item in group]),
+                    callback=lambda future, group=group: self.collect_results(future, group)
+                )
+            except Exception as e:
+                for filepath, base_filename, on_complete, _ in group:
+                    self.fail(filepath, base_filename, on_complete, e)
+
+    def reuse_analysis(self, base_filename, content_hash):
+        """
+        Reuse the analysis of an already indexed file with the same content, so that
+        re-uploads skip the color, metadata and CNN stages.
+        :return: "unchanged" (same name and content, nothing to do), "copied" (same content
+                 under another name that still exists), "renamed" (the other name's file is gone)
+                 or None if the file has to be analysed.
+        """
+        known = [filename for _, filename in self.db_manager.find_images_by_hash(content_hash)]
+        if not known:
+            return None
+        if base_filename in known:
+            return "unchanged"
+
+        source = next((filename for filename in known
+                       if os.path.exists(os.path.join(self.upload_folder, filename))), None)
+        if source is not None:
+            self.db_manager.copy_image(source, base_filename)
+            action = "copied"
+        else:
+            source = known[0]
+            self.db_manager.rename_image(source, base_filename)
+            action = "renamed"
 
-    def image_processing_thread(self, filepath, base_filename):  # Add base_filename parameter
+        if self.term_matrix is not None:
+            self.term_matrix.refresh_images([source, base_filename])
+        if self.embedding_index is not None:
+            vector = self.embedding_index.vector_of(source)
+            if vector is not None:
+                self.embedding_index.add([base_filename], [vector])
+            if action == "renamed":
+                self.embedding_index.remove([source])
+        return action
+
+    def fail(self, filepath, base_filename, on_complete, error):
+        print(f"Error processing {filepath}: {error}")
+        self.write_slots.release()
+        notify(on_complete, base_filename, error)
+
+    def collect_results(self, future, group):
         try:
-            res1 = self.analyze_colors(filepath)
-            res2 = self.get_metadata(filepath)
-            res3 = self.extract_features(filepath)
+            outcomes = future.result()
+        except Exception as e:  # The whole task failed, e.g. a worker process died
+            outcomes = [e] * len(group)
 
-            # Use lock to safely append results
-            with self.lock:
-                self.results.append((base_filename, res1, res2, res3))  # Store base_filename
+        for (filepath, base_filename, on_complete, _), outcome in zip(group, outcomes):
+            if isinstance(outcome, Exception):
+                self.fail(filepath, base_filename, on_complete, outcome)
+            else:
+                res1, res2, res3, info = outcome
+                self.write_queue.put(((base_filename, res1, res2, res3, info), on_complete))  # Store base_filename
 
-        except Exception as e:
-            print(f"Error processing {filepath}: {e}")
-
-    def analyze_colors(self, filepath):
-        analyzer = self.ImageColorAnalyzer(filepath)
-        return analyzer.full_color_analysis()
-
-    def get_metadata(self, filepath):
-        return self.GetMetadata(filepath)
-
-    def extract_features(self, filepath):
-        feature_extractor = self.ImageFeatureExtractor(self.process_top_features)
-        return feature_extractor.get_features(filepath)
-
-    def insert_data(self):
-        with self.lock:
-            for base_filename, res1, res2, res3 in self.results:  # Unpack base_filename
-                if not base_filename:  # Skip if base_filename is empty
-                    continue
-
-                # Insert color analysis data
-                for item in res1:
-                    try:
-                        self.cursor.execute('''
-                            INSERT INTO Imagefeatures (filename, feature_type, feature_value, probability)
-                            VALUES (?, ?, ?, ?)
-                        ''', (base_filename, item['feature_type'], str(item['feature_value']), float(item['probability'])))
-                    except (ValueError, TypeError) as e:
-                        print(f"Error inserting color data for {base_filename}: {e}")
-                        continue  # Skip to the next item
-
-                # Insert metadata
-                for item in res2:
-                    try:
-                        self.cursor.execute('''
-                            INSERT INTO Imagefeatures (filename, feature_type, feature_value, probability)
-                            VALUES (?, ?, ?, ?)
-                        ''', (base_filename, item['feature_type'], str(item['feature_value']), float(item['probability'])))
-                    except (ValueError, TypeError) as e:
-                        print(f"Error inserting metadata for {base_filename}: {e}")
-                        continue  # Skip
-
-                # Insert feature extraction data
-                for item in res3:
-                    try:
-                        self.cursor.execute('''
-                            INSERT INTO Imagefeatures (filename, feature_type, feature_value, probability)
-                            VALUES (?, ?, ?, ?)
-                        ''', (base_filename, item['feature_type'], str(item['feature_value']), float(item['probability'])))
-                    except (ValueError, TypeError) as e:
-                        print(f"Error inserting feature data for {base_filename}: {e}")
-                        continue
-
-            self.conn.commit()
-
-
-    def wait_for_completion(self):
-        for thread in self.threads:
-            thread.join()
-        self.insert_data()
\ No newline at end of file
+    def writer_loop(self):
+        """
+        Commit finished images as soon as they arrive. When several images are already
+        waiting, up to commit_batch_size of them are grouped into one commit.
+        """
+        while True:
+            batch = [self.write_queue.get()]
+            while len(batch) < self.commit_batch_size:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            error = None
+            try:
+                self.insert_data([result for result, _ in batch])
+            except Exception as e:
+                print(f"Error writing features for {[result[0] for result, _ in batch]}: {e}")
+                error = e
+            finally:
+                for result, on_complete in batch:
+                    self.write_slots.release()
+                    notify(on_complete, result[0], error)
+                for _ in batch:
+                    self.write_queue.task_done()
+
+    def insert_data(self, results):
+        """
+        Write the features of a group of images with one executemany in one transaction.
+        """
+        start = time.perf_counter()
+        written = write_results(self.db_manager, results)
+        print(f"Committed {len(results)} image(s), {written} rows in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        if self.term_matrix is not None:
+            self.term_matrix.refresh_images([item[0] for item in results if item[0]])
+            self.term_matrix.maybe_save()
+
+        if self.embedding_index is not None:
+            embedded = [(item[0], item[4].get("embedding")) for item in results
+                        if item[0] and item[4].get("embedding") is not None]
+            if embedded:
+                filenames, vectors = zip(*embedded)
+                self.embedding_index.add(filenames, vectors)
+                self.embedding_index.schedule_maintenance()  # Re-analysed images leave tombstones
\ No newline at end of file
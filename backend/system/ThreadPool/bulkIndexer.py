@@ -0,0 +1,332 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import argparse
+import threading
+
+# Run as a module from backend/system: python -m ThreadPool.bulkIndexer <directory>
+from ThreadPool.threads import ThreadPool
+from ThreadPool.ImageProcessorManager import write_results, extract_features
+from SQLmethods.connectDB import get_db_manager, BACKEND_DIR
+from utils.imageContext import ImageContext
+from utils.thumbnailCache import ThumbnailCache, file_hash
+
+STORAGE_DIR = os.path.join(BACKEND_DIR, 'storage')  # Same folder as UPLOAD_FOLDER in main.py
+CHECKPOINT_PATH = os.path.join(BACKEND_DIR, 'bulk_index.checkpoint')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+def storage_name(base_filename, content_hash):
+    """Name used when another file with the same base name but different content is stored."""
+    stem, extension = os.path.splitext(base_filename)
+    return f"{stem}-{content_hash[:10]}{extension}"
+
+def place_file(source, storage_dir, base_filename, content_hash, link=False):
+    """
+    Put a copy (or hard link) of source into storage, without overwriting a different file.
+    :param base_filename: Preferred name, or None if it is already taken by another file of this run
+    :return: The base filename it is stored under.
+    """
+    name = base_filename or storage_name(os.path.basename(source), content_hash)
+    target = os.path.join(storage_dir, name)
+    if os.path.exists(target) and file_hash(target) != content_hash:
+        name = storage_name(name, content_hash)
+        target = os.path.join(storage_dir, name)
+    if not os.path.exists(target):
+        tmp_path = os.path.join(storage_dir, f".{name}.{os.getpid()}.tmp")  # Hidden, like the upload spool files
+        try:
+            if not link:
+                raise OSError("copy requested")
+            os.link(source, tmp_path)
+        except OSError:  # Also when source and storage are on different file systems
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)  # The server never sees a partial file
+    return name
+
+# Per worker process: the extractor (and its model)
+_worker = None
+
+def worker_state(torch_threads, thumbnails):
+    global _worker
+    if _worker is None:
+        from methods.getFeaturesCNN import ImageFeatureExtractor
+        from methods.modelRegistry import limit_torch_threads
+        from tokenisation.wordnetExtraction import process_top_features
+        limit_torch_threads(torch_threads)  # Workers share the cores instead of oversubscribing them
+        _worker = {
+            "extractor": ImageFeatureExtractor(process_top_features),
+            "thumbnail_cache": ThumbnailCache() if thumbnails else None,
+        }
+    return _worker
+
+def index_batch(entries, storage_dir, link=False, thumbnails=True, torch_threads=None):
+    """
+    Analyse a batch of files in a worker process. Colors, metadata and thumbnails run per
+    image on the decoded pixels; the CNN stage runs once for the whole batch.
+    :param entries: List of (source path, preferred base filename or None, content hash)
+    :return: One (source, status, base filename, result or error) per entry, where status is
+             "indexed" or "failed".
+    """
+    from methods.getColors import ImageColorAnalyzer
+    from methods.getMetadata import GetMetadata
+    state = worker_state(torch_threads, thumbnails)
+
+    outcomes = []
+    prepared = []  # (source, base filename, path in storage, ImageContext, res1, res2, info)
+    for source, base_filename, content_hash in entries:
+        try:
+            image_context = ImageContext(source)  # Fails before anything is stored if it is not an image
+            base_filename = place_file(source, storage_dir, base_filename, content_hash, link)
+            filepath = os.path.join(storage_dir, base_filename)
+            res1 = ImageColorAnalyzer(filepath, image_context=image_context).full_color_analysis()
+            res2 = GetMetadata(filepath, image_context=image_context)
+            info = {"content_hash": content_hash, "file_size": os.path.getsize(filepath)}
+            if state["thumbnail_cache"] is not None:
+                try:
+                    state["thumbnail_cache"].create_thumbnails(filepath, image_context=image_context, digest=content_hash)
+                except Exception as e:  # Rebuilt on demand, do not lose the features
+                    print(f"Error creating thumbnails for {filepath}: {e}")
+            prepared.append((source, base_filename, filepath, image_context, res1, res2, info))
+        except Exception as e:
+            outcomes.append((source, "failed", base_filename, str(e)))
+
+    if prepared:
+        extracted = extract_features(state["extractor"], [item[2] for item in prepared], [item[3] for item in prepared])
+        for (source, base_filename, _, _, res1, res2, info), result in zip(prepared, extracted):
+            if isinstance(result, Exception):
+                outcomes.append((source, "failed", base_filename, str(result)))
+                continue
+            res3, info["embedding"] = result
+            outcomes.append((source, "indexed", base_filename, (base_filename, res1, res2, res3, info)))
+    return outcomes
+
+class BulkIndexer:
+    def __init__(self, db_manager, storage_dir=STORAGE_DIR, checkpoint_path=CHECKPOINT_PATH, workers=None,
+                 batch_size=8, commit_every=256, link=False, thumbnails=True, embedding_index=None):
+        """
+        Offline import of existing image directories, without going through /upload.
+        Files are hashed in this process, and content that is already indexed (or queued
+        earlier in the same run) is recorded as a duplicate without being sent to a worker.
+        A duplicate of a file queued in this run is recorded once that file is committed,
+        and fails with it, so --resume retries both.
+        Batches of the other files are analysed in a process pool (one model per process, one forward
+        pass per batch), results are written in large transactions, and every committed file
+        is appended to a checkpoint so an interrupted import can continue with resume=True.
+        Run it while the server is stopped; the server picks up the new rows on its next start.
+        :param workers: Worker processes (default: number of CPU cores)
+        :param batch_size: Images per worker task and per forward pass
+        :param commit_every: Images written per transaction
+        :param link: Hard-link files into storage instead of copying them (copies across file systems)
+        :param thumbnails: Also write the thumbnail pyramid of every image
+        :param embedding_index: EmbeddingIndex that receives the pooled embeddings (optional)
+        """
+        self.db_manager = db_manager
+        self.storage_dir = storage_dir
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.link = link
+        self.thumbnails = thumbnails
+        self.embedding_index = embedding_index
+        self.torch_threads = max(1, (os.cpu_count() or 1) // self.workers)
+
+        self.results = queue.Queue()
+        self.finished = {}  # Source analysed in this run -> (status, base filename, error), writer thread only
+        self.held = {}      # Source -> duplicates waiting for its outcome, writer thread only
+        self.released = []  # Outcomes of held duplicates, committed with the next group
+        self.counts = {"indexed": 0, "duplicate": 0, "failed": 0, "skipped": 0}
+        self.start_time = None
+        os.makedirs(storage_dir, exist_ok=True)
+
+    def scan(self, root):
+        """Image files below root, in a stable order so resumed runs see the same sequence."""
+        for directory, subdirectories, files in os.walk(root):
+            subdirectories.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.abspath(os.path.join(directory, name))
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            return {line.rstrip('\n') for line in f if line.endswith('\n')}  # A torn last line is redone
+
+    def run(self, root, resume=False):
+        """
+        Index every image below root.
+        :param resume: Skip the files recorded in the checkpoint of an earlier run
+        :return: Counts of indexed, duplicate, failed and skipped files.
+        """
+        done = self.load_checkpoint() if resume else set()
+        if not resume and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        # Names stored so far, so that equal base names from different folders do not overwrite each other
+        taken = {filename for filename, in self.db_manager.fetch_query_results("SELECT filename FROM images")}
+        # Content hash -> stored filename (or source of this run), so identical files are analysed once
+        known = dict(self.db_manager.fetch_query_results(
+            "SELECT content_hash, filename FROM images WHERE content_hash IS NOT NULL"))
+        queued = {}  # Content hash -> first source of this run with that content
+
+        pool = ThreadPool(max_threads=self.workers, max_queue=self.workers, kind='process')
+        writer = threading.Thread(target=self.writer_loop)
+        writer.start()
+        self.start_time = time.perf_counter()
+        try:
+            batch = []
+            for source in self.scan(root):
+                if source in done:
+                    self.counts["skipped"] += 1
+                    continue
+                try:
+                    content_hash = file_hash(source)
+                except OSError as e:
+                    self.results.put(([(source, "failed", None, str(e))], None))
+                    continue
+                if content_hash in known:
+                    self.results.put(([(source, "duplicate", known[content_hash], None)], None))
+                    continue
+                if content_hash in queued:  # Resolved by the writer once the first source is committed
+                    self.results.put(([(source, "same_as", queued[content_hash], None)], None))
+                    continue
+                queued[content_hash] = source
+                base_filename = os.path.basename(source)
+                if base_filename in taken:
+                    base_filename = None  # The worker stores it under a name that includes its hash
+                else:
+                    taken.add(base_filename)
+                batch.append((source, base_filename, content_hash))
+                if len(batch) == self.batch_size:
+                    self.submit(pool, batch)
+                    batch = []
+            if batch:
+                self.submit(pool, batch)
+            pool.join_all()
+        finally:
+            self.results.put(None)
+            writer.join()
+        self.report(final=True)
+        return self.counts
+
+    def submit(self, pool, batch):
+        # Blocks while every worker is busy and `workers` batches are waiting
+        pool.add_thread(index_batch,
+                        args=(batch, self.storage_dir, self.link, self.thumbnails, self.torch_threads),
+                        callback=lambda future, batch=batch: self.results.put((batch, future)))
+
+    def writer_loop(self):
+        pending = []
+        while True:
+            try:
+                item = self.results.get(timeout=5)
+            except queue.Empty:  # Slow batches: do not hold finished work back for long
+                item = ()
+            if item:
+                batch, future = item
+                if future is None:  # Outcomes decided in the parent (duplicates, unreadable files)
+                    for source, status, base_filename, error in batch:
+                        if status == "same_as":
+                            self.hold_duplicate(source, base_filename, pending)
+                        else:
+                            pending.append((source, status, base_filename, error))
+                else:
+                    try:
+                        pending.extend(future.result())
+                    except Exception as e:  # The worker itself died, e.g. the model could not be loaded
+                        print(f"Error indexing {len(batch)} file(s) starting with {batch[0][0]}: {e}")
+                        pending.extend((source, "failed", base_filename, str(e)) for source, base_filename, _ in batch)
+            if pending and (not item or len(pending) >= self.commit_every):
+                self.commit(pending)
+                pending, self.released = self.released, []
+            if item is None:
+                if pending:  # Duplicates released by the last commit
+                    self.commit(pending)
+                return
+
+    def hold_duplicate(self, source, original, pending):
+        """
+        Record a file with the content of `original` (queued earlier in this run): a duplicate
+        if original was indexed, failed if original failed, or held until original is committed.
+        """
+        outcome = self.finished.get(original)
+        if outcome is None:
+            self.held.setdefault(original, []).append(source)
+        else:
+            pending.append(self.duplicate_outcome(source, original, outcome))
+
+    @staticmethod
+    def duplicate_outcome(source, original, outcome):
+        status, base_filename, error = outcome
+        if status == "indexed":
+            return source, "duplicate", base_filename, None
+        return source, "failed", None, f"Same content as {original}, which failed: {error}"
+
+    def commit(self, outcomes):
+        """
+        Write a group of results in one transaction, then record them in the checkpoint.
+        Failed files are not recorded, so --resume tries them again.
+        """
+        results = [result for _, status, _, result in outcomes if status == "indexed"]
+        write_results(self.db_manager, results)
+
+        if self.embedding_index is not None:
+            embedded = [(result[0], result[4]["embedding"]) for result in results if result[4].get("embedding") is not None]
+            if embedded:
+                filenames, vectors = zip(*embedded)
+                self.embedding_index.add(filenames, vectors)
+
+        with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(source + '\n' for source, status, _, _ in outcomes if status != "failed"))
+            f.flush()
+            os.fsync(f.fileno())
+
+        for source, status, base_filename, error in outcomes:
+            self.counts[status] += 1
+            if status == "failed":
+                print(f"Failed {source}: {error}")
+            if status in ("indexed", "failed"):
+                outcome = (status, base_filename, error if status == "failed" else None)
+                self.finished[source] = outcome
+                self.released.extend(self.duplicate_outcome(duplicate, source, outcome)
+                                     for duplicate in self.held.pop(source, ()))
+        self.report()
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.start_time
+        processed = self.counts["indexed"] + self.counts["duplicate"] + self.counts["failed"]
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        print(f"{'Finished' if final else 'Progress'}: {self.counts['indexed']} indexed, {self.counts['duplicate']} duplicate, "
+              f"{self.counts['failed']} failed, {self.counts['skipped']} skipped in {elapsed:.1f}s ({rate:.2f} images/s)")
+
+
+if __name__ == '__main__':
+    #   cd backend/system && python -m ThreadPool.bulkIndexer /path/to/photos [--resume]
+    parser = argparse.ArgumentParser(description="Index an existing image directory tree without the web server")
+    parser.add_argument('root', help="Directory to walk")
+    parser.add_argument('--resume', action='store_true', help="Skip files committed by an earlier, interrupted run")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: number of CPU cores)")
+    parser.add_argument('--batch-size', type=int, default=8, help="Images per forward pass")
+    parser.add_argument('--commit-every', type=int, default=256, help="Images written per transaction")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--link', action='store_true', help="Hard-link files into storage instead of copying them")
+    parser.add_argument('--no-thumbnails', action='store_true', help="Leave thumbnails to be built on first request")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        sys.exit(f"Not a directory: {args.root}")
+
+    from Retrieval.embeddingIndex import EmbeddingIndex
+    from Retrieval.termMatrix import TermMatrix
+    db_manager = get_db_manager()
+    indexer = BulkIndexer(db_manager, checkpoint_path=args.checkpoint, workers=args.workers, batch_size=args.batch_size,
+                          commit_every=args.commit_every, link=args.link, thumbnails=not args.no_thumbnails,
+                          embedding_index=EmbeddingIndex())
+    counts = indexer.run(args.root, resume=args.resume)
+
+    if counts["indexed"]:
+        # One full build instead of an incremental refresh per commit
+        term_matrix = TermMatrix(db_manager)
+        term_matrix.build()
+        term_matrix.save()
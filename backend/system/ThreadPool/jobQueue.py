@@ -0,0 +1,163 @@
+import threading
+import time
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+class JobQueue:
+    def __init__(self, db_manager, image_manager, max_attempts=3, base_delay=2.0, poll_interval=1.0, max_in_flight=None):
+        """
+        Durable ingestion queue kept in the ingest_jobs / ingest_tasks tables.
+        Every upload becomes a job with one task per file. A dispatcher thread hands due
+        tasks to the ImageProcessingManager and records the outcome once the features are
+        committed. Failed attempts are retried with exponential backoff, and tasks that were
+        running when the process stopped are queued again by start().
+        :param max_attempts: Attempts per task before it is marked failed
+        :param base_delay: Seconds before the first retry, doubled for every further attempt
+        :param poll_interval: Seconds between checks for tasks whose backoff has expired
+        :param max_in_flight: Tasks handed to the manager at once (default: its workers plus queue)
+        """
+        self.db_manager = db_manager
+        self.image_manager = image_manager
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.poll_interval = poll_interval
+        pool = image_manager.pool
+        self.max_in_flight = max_in_flight or pool.max_threads + pool.max_queue
+
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.dispatcher = None
+
+    def start(self):
+        """
+        Resume unfinished work and start the dispatcher thread.
+        """
+        with self.db_manager.transaction() as conn:
+            resumed = conn.execute("UPDATE ingest_tasks SET state = ?, started_at = NULL WHERE state = ?",
+                                   (QUEUED, RUNNING)).rowcount
+        if resumed:
+            print(f"Resuming {resumed} interrupted ingest task(s)")
+        self.dispatcher = threading.Thread(target=self.dispatch_loop, daemon=True)
+        self.dispatcher.start()
+        self.wakeup.set()
+
+    def create_job(self, new_files, reused=None):
+        """
+        Create a job for one upload.
+        :param new_files: (base filename, content hash) of the files to analyse
+        :param reused: {base filename: action} of files that reused an existing analysis;
+                       they are recorded as done straight away
+        :return: The job id.
+        """
+        reused = reused or {}
+        now = time.time()
+        with self.db_manager.transaction() as conn:
+            job_id = conn.execute("INSERT INTO ingest_jobs (created_at, finished_at) VALUES (?, ?)",
+                                  (now, None if new_files else now)).lastrowid
+            conn.executemany("INSERT INTO ingest_tasks (job_id, filename, content_hash) VALUES (?, ?, ?)",
+                             [(job_id, filename, content_hash) for filename, content_hash in new_files])
+            conn.executemany("INSERT INTO ingest_tasks (job_id, filename, state, result, finished_at) VALUES (?, ?, ?, ?, ?)",
+                             [(job_id, filename, DONE, action, now) for filename, action in reused.items()])
+        self.wakeup.set()
+        return job_id
+
+    def dispatch_loop(self):
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                self.dispatch()
+            except Exception as e:
+                print(f"Error dispatching ingest tasks: {e}")
+
+    def dispatch(self):
+        """
+        Claim due tasks (oldest first) up to the in-flight limit and submit them.
+        """
+        with self.lock:
+            free = self.max_in_flight - self.in_flight
+        if free <= 0:
+            return
+        now = time.time()
+        with self.db_manager.transaction() as conn:
+            tasks = conn.execute(
+                "SELECT id, filename, content_hash FROM ingest_tasks WHERE state = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (QUEUED, now, free)).fetchall()
+            conn.executemany("UPDATE ingest_tasks SET state = ?, attempts = attempts + 1, started_at = ? WHERE id = ?",
+                             [(RUNNING, now, task_id) for task_id, _, _ in tasks])
+        with self.lock:
+            self.in_flight += len(tasks)
+
+        for task_id, filename, content_hash in tasks:
+            try:
+                # Blocks while the manager's queue is full
+                self.image_manager.process_image(
+                    filename, on_complete=lambda _, error, task_id=task_id: self.complete(task_id, error),
+                    content_hash=content_hash)
+            except Exception as e:
+                self.complete(task_id, e)
+
+    def complete(self, task_id, error):
+        """
+        Record the outcome of one attempt: done, queued again after a backoff, or failed.
+        """
+        now = time.time()
+        with self.db_manager.transaction() as conn:
+            job_id, attempts = conn.execute("SELECT job_id, attempts FROM ingest_tasks WHERE id = ?", (task_id,)).fetchone()
+            if error is None:
+                conn.execute("UPDATE ingest_tasks SET state = ?, result = 'analysed', error = NULL, finished_at = ? WHERE id = ?",
+                             (DONE, now, task_id))
+            elif attempts < self.max_attempts:
+                conn.execute("UPDATE ingest_tasks SET state = ?, error = ?, next_attempt_at = ? WHERE id = ?",
+                             (QUEUED, str(error), now + self.base_delay * 2 ** (attempts - 1), task_id))
+            else:
+                conn.execute("UPDATE ingest_tasks SET state = ?, error = ?, finished_at = ? WHERE id = ?",
+                             (FAILED, str(error), now, task_id))
+            conn.execute(
+                "UPDATE ingest_jobs SET finished_at = ? WHERE id = ? AND NOT EXISTS "
+                "(SELECT 1 FROM ingest_tasks WHERE job_id = ? AND state IN (?, ?))",
+                (now, job_id, job_id, QUEUED, RUNNING))
+        with self.lock:
+            self.in_flight -= 1
+        self.wakeup.set()
+
+    def status(self, job_id):
+        """
+        Progress of a job: task counts per state, throughput of the analysed files,
+        an estimate of the remaining time and the errors of failed tasks.
+        :return: Status dict, or None if the job does not exist.
+        """
+        job = self.db_manager.fetch_query_results("SELECT created_at, finished_at FROM ingest_jobs WHERE id = ?", (job_id,))
+        if not job:
+            return None
+        created_at, finished_at = job[0]
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update(self.db_manager.fetch_query_results(
+            "SELECT state, COUNT(*) FROM ingest_tasks WHERE job_id = ? GROUP BY state", (job_id,)))
+        (analysed, started), = self.db_manager.fetch_query_results(
+            "SELECT TOTAL(state IN (?, ?)), MIN(started_at) FROM ingest_tasks WHERE job_id = ? AND attempts > 0",
+            (DONE, FAILED, job_id))
+        failed = self.db_manager.fetch_query_results(
+            "SELECT filename, attempts, error FROM ingest_tasks WHERE job_id = ? AND state = ? ORDER BY id",
+            (job_id, FAILED))
+
+        now = time.time()
+        remaining = counts[QUEUED] + counts[RUNNING]
+        busy = ((finished_at or now) - started) if started is not None else 0.0
+        throughput = analysed / busy if analysed and busy > 0 else None  # Images per second
+        eta = 0.0 if not remaining else (remaining / throughput if throughput else None)
+        return {
+            'job_id': job_id,
+            'state': 'finished' if finished_at is not None else 'running',
+            'total': sum(counts.values()),
+            'counts': counts,
+            'elapsed_seconds': round((finished_at or now) - created_at, 3),
+            'images_per_second': round(throughput, 3) if throughput else None,
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+            'errors': [{'file': filename, 'attempts': attempts, 'error': error} for filename, attempts, error in failed],
+        }
+
+    def latest_job_id(self):
+        rows = self.db_manager.fetch_query_results("SELECT MAX(id) FROM ingest_jobs")
+        return rows[0][0] if rows else None
@@ -1,37 +1,73 @@
+import os
 import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 class ThreadPool:
-    def __init__(self, max_threads):
+    def __init__(self, max_threads=None, max_queue=None, kind='thread'):
         """
-        Initialize the ThreadPool with a maximum number of concurrent threads.
-        :param max_threads: Maximum number of concurrent threads.
+        Bounded executor with a fixed number of workers and a bounded queue of pending tasks.
+        :param max_threads: Number of workers (default: number of CPU cores).
+        :param max_queue: Number of tasks allowed to wait for a worker (default: 2 * max_threads).
+                          add_thread blocks once this many tasks are waiting (backpressure).
+        :param kind: 'thread' for a thread pool, 'process' for a process pool. Process workers
+                     need a picklable, module-level target. They are started with spawn: forking
+                     a process whose other threads may hold locks can deadlock the children.
         """
-        self.max_threads = max_threads
-        self.threads = []
-        self.lock = threading.Lock()
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.max_threads = max_threads or os.cpu_count() or 1
+        self.max_queue = max_queue if max_queue is not None else 2 * self.max_threads
+        self.kind = kind
 
-    def add_thread(self, target, args=()):
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_threads, mp_context=multiprocessing.get_context('spawn'))
+        self.slots = threading.BoundedSemaphore(self.max_threads + self.max_queue)
+        self.pending = 0
+        self.lock = threading.Condition()
+
+    def add_thread(self, target, args=(), callback=None):
         """
-        Add a thread to the pool and start it if the limit is not exceeded.
-        :param target: The target function to run in the thread.
+        Submit a task, blocking while the pool and its queue are full.
+        :param target: The target function to run in a worker.
         :param args: Arguments for the target function.
-        :return: True if the thread was started, False if limit is reached.
+        :param callback: Optional function called with the finished Future.
+        :return: The Future of the submitted task.
         """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(target, *args)
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.pending += 1
+        if callback is not None:
+            future.add_done_callback(callback)
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        # Runs after the task's own callback, so join_all also waits for callbacks
+        self.slots.release()
         with self.lock:
-            if len(self.threads) < self.max_threads:
-                thread = threading.Thread(target=target, args=args)
-                thread.start()
-                self.threads.append(thread)
-                return True
-            else:
-                return False
+            self.pending -= 1
+            if self.pending == 0:
+                self.lock.notify_all()
 
     def join_all(self):
         """
-        Wait for all threads in the pool to finish.
+        Wait for all submitted tasks (and their callbacks) to finish.
         """
-        for thread in self.threads:
-            thread.join()
+        with self.lock:
+            while self.pending:
+                self.lock.wait()
 
-        # Clear the thread list once all are done
-        self.threads.clear()
\ No newline at end of file
+    def shutdown(self, wait_for_tasks=True):
+        """
+        Stop the workers once the submitted tasks are done.
+        """
+        self.executor.shutdown(wait=wait_for_tasks)
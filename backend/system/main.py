@@ -1,30 +1,33 @@
 # --- START OF FILE main.py ---
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, url_for, Response, stream_with_context
 from flask_cors import CORS
 import os
-import io
 import logging
-import base64
-from PIL import Image
-from io import BytesIO
-import threading
+import atexit
 import nltk
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 from sklearn.feature_extraction.text import TfidfVectorizer
 import re
+import json
 
 ''' Import classes from other files '''
-from utils.checkIfImage import is_valid_image
-from SQLmethods.connectDB import ConnectDB, get_db_manager
+from utils.uploadSpool import spool_upload, UploadTooLarge, NotAnImage
+from utils.thumbnailCache import ThumbnailCache
+from SQLmethods.connectDB import get_db_manager, USER_FEEDBACK_TYPE
 from methods.getColors import ImageColorAnalyzer
 from methods.getMetadata import GetMetadata
-from methods.getFeaturesCNN import ImageFeatureExtractor
+from methods.getFeaturesCNN import ImageFeatureExtractor, PROCESSOR_PATH, MODEL_PATH
+from methods.modelRegistry import get_model_registry, INFERENCE_BACKEND
 from ThreadPool.ImageProcessorManager import ImageProcessingManager
+from ThreadPool.jobQueue import JobQueue
 from tokenisation.wordnetExtraction import process_top_features
-from tokenisation.SentenceConv import SentenceConverter
+from tokenisation.SentenceConv import get_sentence_converter
 from Retrieval.RetrieveAlgo import VectorSpaceModel
+from Retrieval.termMatrix import get_term_matrix
+from Retrieval.embeddingIndex import get_embedding_index
+from utils.imageContext import ImageContext
 
 # Initialize Flask app and CORS
 app = Flask(__name__)
@@ -34,8 +37,7 @@ CORS(app)
 nltk.download('stopwords')
 nltk.download('punkt')
 
-# Get database connection and cursor (ensure correct path)
-cursor, conn = ConnectDB()
+# Get database manager (ensure correct path)
 db_manager = get_db_manager()
 
 # Configure upload folder
@@ -43,80 +45,194 @@ UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../sto
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Process Manager Initialization
-image_manager = ImageProcessingManager(
-    upload_folder=UPLOAD_FOLDER,
-    ImageColorAnalyzer=ImageColorAnalyzer,
-    GetMetadata=GetMetadata,
-    ImageFeatureExtractor=ImageFeatureExtractor,
-    process_top_features=process_top_features,
-    cursor=cursor,
-    conn=conn
-)
+# Upload size limits. Requests above MAX_REQUEST_BYTES are rejected with 413 before they are read.
+MAX_FILE_BYTES = int(os.environ.get('CBIR_MAX_FILE_MB', 100)) * 1024 * 1024
+MAX_REQUEST_BYTES = int(os.environ.get('CBIR_MAX_REQUEST_MB', 1024)) * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
-# Store processing errors
-processing_errors = []
+# Process workers (CBIR_INGEST_EXECUTOR=process) are started with spawn, which imports this module
+# again as __mp_main__. They only need the analysis functions, not the server state below.
+SERVER_PROCESS = __name__ != '__mp_main__'
+
+if SERVER_PROCESS:
+    # Load the ViT model once for the whole process and warm it up before serving requests
+    model_registry = get_model_registry(PROCESSOR_PATH, MODEL_PATH, INFERENCE_BACKEND)
+    try:
+        model_registry.warmup()
+        logging.info(f"Model registry ready: {model_registry.stats()}")
+    except Exception as e:
+        logging.error(f"Error warming up model: {str(e)}")
+
+    # Thumbnails are written at ingest time and referenced by URL in responses
+    thumbnail_cache = ThumbnailCache(hash_lookup=db_manager.get_content_hash)
+
+    # Load (or build) the image-term matrix used for retrieval
+    term_matrix = get_term_matrix()
+    atexit.register(term_matrix.save)
+
+    # Pooled image embeddings for query-by-example (memory-mapped, written as they arrive)
+    embedding_index = get_embedding_index()
+
+    # Load the query tokenizer once
+    get_sentence_converter()
+
+    # Process Manager Initialization
+    image_manager = ImageProcessingManager(
+        upload_folder=UPLOAD_FOLDER,
+        ImageColorAnalyzer=ImageColorAnalyzer,
+        GetMetadata=GetMetadata,
+        ImageFeatureExtractor=ImageFeatureExtractor,
+        process_top_features=process_top_features,
+        db_manager=db_manager,
+        term_matrix=term_matrix,
+        thumbnail_cache=thumbnail_cache,
+        embedding_index=embedding_index,
+        max_workers=int(os.environ.get('CBIR_INGEST_WORKERS', os.cpu_count() or 1)),
+        max_queue=int(os.environ.get('CBIR_INGEST_QUEUE', 16)),
+        executor_kind=os.environ.get('CBIR_INGEST_EXECUTOR', 'thread'),  # 'thread' or 'process'
+        inference_batch_size=int(os.environ.get('CBIR_INFERENCE_BATCH', 8))
+    )
+
+    # Uploads are queued as jobs in the database; unfinished jobs resume after a restart
+    job_queue = JobQueue(
+        db_manager=db_manager,
+        image_manager=image_manager,
+        max_attempts=int(os.environ.get('CBIR_INGEST_ATTEMPTS', 3))
+    )
+    job_queue.start()
+
+# Thumbnail size referenced by URL in responses unless the request sets one
+DEFAULT_THUMBNAIL_SIZE = 256
+
+# Results per /search page unless the request sets 'limit'
+DEFAULT_SEARCH_LIMIT = 50
+
+# Page sizes of /all_images
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
 def save_valid_files(files):
     """
     Save valid image files (only base filenames).
+    Each file is streamed to a temporary file in the upload folder (hashed and validated on the way)
+    and then renamed into place, so no upload is held in memory as a whole.
+    A file whose name and content are both already stored is not written again.
+    Returns (saved, invalid, too_large): saved is a list of (base filename, SHA-1 content hash).
     """
-    valid_files = []
+    saved_files = []
     invalid_files = []
+    too_large = []
+    request_bytes = 0
     for file in files:
         if file and file.filename:
-            file_stream = io.BytesIO(file.read())
-            file.seek(0)  # Rewind the file stream
-            if is_valid_image(file_stream):
-                valid_files.append(file)
-            else:
+            remaining = MAX_REQUEST_BYTES - request_bytes
+            try:
+                tmp_path, content_hash, size = spool_upload(file.stream, app.config['UPLOAD_FOLDER'],
+                                                            max_bytes=min(MAX_FILE_BYTES, remaining))
+            except UploadTooLarge:
+                too_large.append(file.filename)
+                continue
+            except NotAnImage:
                 invalid_files.append(file.filename)
-    for file in valid_files:
-        base_filename = os.path.basename(file.filename)
-        file.seek(0)  # Rewind again before saving
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], base_filename))
-    return valid_files, invalid_files
+                continue
+            request_bytes += size
+            base_filename = os.path.basename(file.filename)
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], base_filename)
+            if os.path.exists(file_path) and thumbnail_cache.known_hash(file_path) == content_hash:
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, file_path)  # Readers see the old file or the new one, never a partial one
+            saved_files.append((base_filename, content_hash))
+    return saved_files, invalid_files, too_large
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f'Request exceeds {MAX_REQUEST_BYTES // (1024 * 1024)} MB'}), 413
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handles file uploads."""
+    """
+    Handles file uploads.
+    Files whose content is already indexed reuse that analysis (see ImageProcessingManager.reuse_analysis),
+    only new content is queued as a job and analysed in the background.
+    """
     if 'files[]' not in request.files:
         return jsonify({'error': 'No files part'}), 400
     files = request.files.getlist('files[]')
     if not files:
         return jsonify({'error': 'No selected files'}), 400
 
-    valid_files, invalid_files = save_valid_files(files)
-
-    def process_files_in_background(valid_files):
-        global processing_errors
-        processing_errors = []  # Clear previous errors
-        for file in valid_files:
-            try:
-                base_filename = os.path.basename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], base_filename)
-                image_manager.process_image(base_filename)  # Pass only base filename
-            except Exception as e:
-                logging.error(f"Error processing {file.filename}: {str(e)}")
-                processing_errors.append({'file': file.filename, 'error': str(e)})
-        image_manager.wait_for_completion()
+    saved_files, invalid_files, too_large = save_valid_files(files)
+
+    reused = {}  # base filename -> "unchanged", "copied" or "renamed"
+    new_files = []  # (base filename, content hash), the hash is reused by the analysis
+    for base_filename, content_hash in saved_files:
+        try:
+            action = image_manager.reuse_analysis(base_filename, content_hash)
+        except Exception as e:
+            logging.error(f"Error reusing the analysis of {base_filename}: {str(e)}")
+            action = None
+        if action is None:
+            new_files.append((base_filename, content_hash))
+        else:
+            reused[base_filename] = action
 
-    background_thread = threading.Thread(target=process_files_in_background, args=(valid_files,))
-    background_thread.start()
+    job_id = job_queue.create_job(new_files, reused)
 
     return jsonify({
         'message': 'Files are being processed in the background',
         'invalid_files': invalid_files,
-        'valid_files': [os.path.basename(file.filename) for file in valid_files]  # Return base filenames
-    }), 200
+        'too_large_files': too_large,
+        'valid_files': [base_filename for base_filename, _ in saved_files],  # Return base filenames
+        'processing': [base_filename for base_filename, _ in new_files],
+        'reused': reused,
+        'job_id': job_id,
+        'status_url': url_for('get_job_status', job_id=job_id)
+    }), 202
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Progress of an upload job: task counts, images per second, ETA and errors."""
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(status), 200
 
 @app.route('/processing_errors', methods=['GET'])
 def get_processing_errors():
-    """Returns processing errors."""
-    global processing_errors
-    if processing_errors:
-        return jsonify({'message': 'Some images could not be processed', 'errors': processing_errors}), 200
-    return jsonify({'message': 'No errors occurred during processing'}), 200
+    """Returns the processing errors of the latest upload job (see /jobs/<id> for a specific one)."""
+    job_id = job_queue.latest_job_id()
+    errors = job_queue.status(job_id)['errors'] if job_id is not None else []
+    if errors:
+        return jsonify({'message': 'Some images could not be processed', 'job_id': job_id, 'errors': errors}), 200
+    return jsonify({'message': 'No errors occurred during processing', 'job_id': job_id}), 200
+
+@app.route('/model_stats', methods=['GET'])
+def get_model_stats():
+    """Returns model load time and resident memory of this process."""
+    return jsonify(model_registry.stats()), 200
+
+@app.route('/query_stats', methods=['GET'])
+def get_query_stats():
+    """Returns hit-rate counters of the parsed-query cache."""
+    return jsonify(get_sentence_converter().cache_stats()), 200
+
+def thumbnail_url(filename, size=DEFAULT_THUMBNAIL_SIZE):
+    return url_for('get_thumbnail', filename=filename, size=size, _external=True)
+
+@app.route('/thumbnail/<path:filename>', methods=['GET'])
+def get_thumbnail(filename):
+    """Serves a cached thumbnail of an uploaded image, creating it on a cache miss."""
+    size = request.args.get('size', DEFAULT_THUMBNAIL_SIZE, type=int)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(filename))
+    if not os.path.isfile(filepath):
+        return jsonify({'error': 'Image not found'}), 404
+    try:
+        thumbnail_path = thumbnail_cache.get_thumbnail(filepath, size)
+    except Exception as e:
+        logging.error(f"Error creating thumbnail for {filename}: {e}")
+        return jsonify({'error': 'Failed to create thumbnail'}), 500
+    return send_file(thumbnail_path, mimetype='image/jpeg', max_age=86400)
 
 @app.route('/search', methods=['POST'])
 def search_images():
@@ -125,34 +241,82 @@ def search_images():
     query = data.get('query', '')
     if not query:
         return jsonify({'error': 'Query is required.'}), 400
-
     try:
-        filenames = get_query_results(query)  # Use the updated function
-        low_quality_images = []
-        image_filenames = []
-        for filename in filenames:
-            try:
-                with Image.open(os.path.join(app.config['UPLOAD_FOLDER'], filename)) as img:
-                    buffered = BytesIO()
-                    img.save(buffered, format='JPEG')  # Save as JPEG (consistent format)
-                    image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                    low_quality_images.append(image_base64)
-                    image_filenames.append(filename)
-            except FileNotFoundError:
-                logging.warning(f"Image file not found: {filename}")
-                # Handle missing file gracefully (e.g., skip, or return a placeholder)
-                continue
-            except Exception as e:
-                logging.error(f"Error processing image {filename}: {e}")
-                continue  # Continue to the next image
+        limit = int(data.get('limit', DEFAULT_SEARCH_LIMIT))
+        offset = int(data.get('offset', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit and offset must be integers.'}), 400
+    if limit <= 0 or offset < 0:
+        return jsonify({'error': 'limit must be positive and offset non-negative.'}), 400
 
-        return jsonify({'images': low_quality_images, 'filenames': image_filenames}), 200
+    try:
+        filenames, has_more = get_query_results(query, limit, offset)  # Use the updated function
+        thumbnail_size = data.get('thumbnail_size', DEFAULT_THUMBNAIL_SIZE)
+
+        return jsonify({
+            'images': [thumbnail_url(filename, thumbnail_size) for filename in filenames],
+            'filenames': filenames,
+            'offset': offset,
+            'limit': limit,
+            'has_more': has_more,
+            # Ranks of the page, not len(filenames): hits whose file is missing are left out of the page
+            'next_offset': offset + limit if has_more else None
+        }), 200
 
     except Exception as e:
         logging.error(f"Error retrieving images: {str(e)}")
         return jsonify({'error': 'Failed to fetch images. Please try again.'}), 500
 
 
+@app.route('/search_by_image', methods=['POST'])
+def search_by_image():
+    """
+    Query by example: returns the images that look most like the given one.
+    Either upload an image as 'image' (multipart form) or name a stored image with 'filename'.
+    Optional: 'limit', 'thumbnail_size' and 'exact' (brute-force search instead of the approximate index).
+    """
+    params = request.form if request.files else (request.get_json(silent=True) or {})
+    try:
+        limit = int(params.get('limit', DEFAULT_SEARCH_LIMIT))
+        thumbnail_size = int(params.get('thumbnail_size', DEFAULT_THUMBNAIL_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit and thumbnail_size must be integers.'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'limit must be positive.'}), 400
+    exact = str(params.get('exact', '')).lower() in ('1', 'true', 'yes')
+
+    try:
+        exclude = None
+        if 'image' in request.files:
+            image_context = ImageContext(request.files['image'].stream)
+            query = ImageFeatureExtractor(process_top_features).get_embeddings([image_context.rgb])[0]
+        elif params.get('filename'):
+            exclude = os.path.basename(params['filename'])
+            query = embedding_index.vector_of(exclude)
+            if query is None:
+                return jsonify({'error': 'Image not indexed'}), 404
+        else:
+            return jsonify({'error': 'An image or a filename is required.'}), 400
+
+        results = embedding_index.search(query, limit, exact=exact, exclude=exclude)
+        filenames = [filename for filename, _ in results]
+        return jsonify({
+            'images': [thumbnail_url(filename, thumbnail_size) for filename in filenames],
+            'filenames': filenames,
+            'scores': [round(score, 4) for _, score in results],
+            'limit': limit
+        }), 200
+
+    except Exception as e:
+        logging.error(f"Error searching by image: {str(e)}")
+        return jsonify({'error': 'Failed to search by image. Please try again.'}), 500
+
+@app.route('/embedding_stats', methods=['GET'])
+def get_embedding_stats():
+    """Returns the size of the embedding index and whether it is searched approximately."""
+    return jsonify(embedding_index.stats()), 200
+
+
 # --- KEPT THE ORIGINAL FEEDBACK METHOD ---
 @app.route('/feedback', methods=['POST'])
 def handle_feedback():
@@ -163,6 +327,8 @@ def handle_feedback():
     query = data.get('query')
     if not filename or not feedback or not query:
         return jsonify({'error': 'Missing data'}), 400
+    if feedback not in ("positive", "negative"):
+        return jsonify({'error': 'feedback must be "positive" or "negative"'}), 400
 
     try:
         update_probabilities(filename, feedback, query)
@@ -172,61 +338,66 @@ def handle_feedback():
         return jsonify({'error': 'Failed to process feedback'}), 500
 
 def update_probabilities(filename, feedback, query):
-    """Updates probabilities based on feedback."""
-    db_manager = get_db_manager()
+    """
+    Updates probabilities based on feedback.
+    The image is resolved to its id once, every matching term is rescaled by one
+    executemany in one transaction, and the event is recorded in FeedbackHistory.
+    """
     base_filename = os.path.basename(filename)
+    included_words, _ = get_sentence_converter().parse_query(query)  # Cached SentenceConverter
 
-    # --- Simplified Query Processing (for feedback) ---
-    converter = SentenceConverter()
-    processed_query = converter.convert_to_query(query)  # Use SentenceConverter
-    included_words = [word.split()[0] for word in processed_query.split() if not word.startswith("-")] # Extract the words
-    # -------------------------------------------------
+    image_id = db_manager.get_image_id(base_filename)
+    if image_id is None:
+        print(f"Warning: Unknown image {filename} for feedback, query: {query}")
+        return
 
-    placeholders = ', '.join(['?'] * len(included_words))
-    where_clause = f"filename LIKE ? AND feature_value IN ({placeholders})"
+    # Positive feedback raises scores by 20% (at most 1.0), negative lowers them by 20%
+    if feedback == "positive":
+        update = "UPDATE image_terms SET score = MIN(score * 1.2, 1.0) WHERE image_id = ? AND term_id = ?"
+    else:
+        update = "UPDATE image_terms SET score = MAX(score * 0.8, 0.0) WHERE image_id = ? AND term_id = ?"
 
-    current_features = db_manager.fetch_query_results(
-        f"SELECT feature_value, probability FROM Imagefeatures WHERE {where_clause}",
-        ('%' + base_filename, *included_words)
-    )
+    with db_manager.transaction() as conn:
+        conn.execute(
+            "INSERT INTO FeedbackHistory (filename, feedback, query) VALUES (?, ?, ?)",
+            (base_filename, feedback, query)
+        )
+        term_ids = db_manager.get_term_ids(included_words, conn)
+        conn.executemany(update, [(image_id, term_id) for term_id in term_ids.values()])
 
-    if not current_features:
+    if not term_ids:
         print(f"Warning: No matching features found for {filename}, query: {query}")
         return
-
-    for feature_value, probability in current_features:
-        probability = float(probability)
-        new_probability = min(probability * 1.2, 1.0) if feedback == "positive" else max(probability * 0.8, 0.0)
-        print(f"Updating probability for {filename}, {feature_value} from {probability} to {new_probability}")
-        db_manager.execute_query(
-            "UPDATE Imagefeatures SET probability = ? WHERE filename LIKE ? AND feature_value = ?",
-            (new_probability, filename, feature_value)
-        )
+    print(f"Applied {feedback} feedback for {base_filename} to {len(term_ids)} term(s)")
+    term_matrix.refresh_images([base_filename])
 # --- END OF ORIGINAL FEEDBACK METHOD ---
 
 
-def get_query_results(sentence):
+def get_query_results(sentence, limit=None, offset=0):
     """
     Processes the sentence and fetches image filenames.
     Uses SentenceConverter for query processing and VectorSpaceModel for retrieval.
+    Only the top offset + limit images are ranked (all of them if limit is None).
+    Returns the filenames of the requested page and whether more results follow.
     """
-    converter = SentenceConverter()
-    processed_query = converter.convert_to_query(sentence)
-    included_words = [word.split()[0] for word in processed_query.split() if not word.startswith("-")]
+    included_words, _ = get_sentence_converter().parse_query(sentence)
 
-    vsm = VectorSpaceModel(db_manager, included_words, sentence)
-    sorted_vector_df = vsm.get_sorted_vector_df()
+    top_k = offset + limit + 1 if limit is not None else None  # One extra to know if there is a next page
+    vsm = VectorSpaceModel(db_manager, included_words, sentence, term_matrix, top_k=top_k)
+    ranked = vsm.get_sorted_vector_df().index.tolist()
+    page = ranked[offset:offset + limit] if limit is not None else ranked[offset:]
+    has_more = limit is not None and len(ranked) > offset + limit
 
     # Get base filenames, ensuring they exist in the upload folder.
     filenames = []
-    for full_path in sorted_vector_df.index.tolist():
+    for full_path in page:
         base_filename = os.path.basename(full_path)
         if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], base_filename)):
             filenames.append(base_filename)
         else:
             logging.warning(f"File not found in upload folder: {base_filename}") # Log missing files
 
-    return filenames
+    return filenames, has_more
 
 
 @app.route('/user_sentence', methods=['POST'])
@@ -241,6 +412,8 @@ def handle_user_sentence():
     try:
         db_manager = get_db_manager()
         base_filename = os.path.basename(filename)
+        if db_manager.get_image_id(base_filename) is None:
+            return jsonify({'error': 'Image not found'}), 404
 
         # Store the sentence in UserSentences table
         db_manager.execute_query(
@@ -265,7 +438,7 @@ def handle_user_sentence():
 
 
 def process_user_sentences(filename):
-    """Processes user sentences to extract keywords and update Imagefeatures."""
+    """Processes user sentences to extract keywords and update the image's terms."""
     db_manager = get_db_manager()
 
     # Fetch all sentences for the given filename
@@ -279,19 +452,21 @@ def process_user_sentences(filename):
     combined_text = ' '.join(sentences)
     keywords, tfidf_scores = extract_keywords_with_tfidf(combined_text)
 
-    # Delete existing user sentence feedback entries for the filename
-    db_manager.execute_query(
-        "DELETE FROM Imagefeatures WHERE filename = ? AND feature_type = 'User sentence feedback'",
-        (filename,)
-    )
-
-    # Insert the new keywords and their TF-IDF scores as probabilities
-    for keyword, score in zip(keywords, tfidf_scores):
+    with db_manager.transaction():
+        # Delete existing user sentence feedback entries for the filename
         db_manager.execute_query(
-            "INSERT INTO Imagefeatures (filename, feature_type, feature_value, probability) VALUES (?, 'User sentence feedback', ?, ?)",
-            (filename, keyword, score)
+            "DELETE FROM image_terms WHERE image_id = (SELECT id FROM images WHERE filename = ?) "
+            "AND feature_type = ?",
+            (filename, USER_FEEDBACK_TYPE)
         )
 
+        # Insert the new keywords and their TF-IDF scores as probabilities
+        db_manager.insert_features(
+            (filename, USER_FEEDBACK_TYPE, keyword, 'Original', float(score))
+            for keyword, score in zip(keywords, tfidf_scores)
+        )
+    term_matrix.refresh_images([filename])
+
 def extract_keywords_with_tfidf(text):
     """
     Extracts keywords from the given text using TF-IDF.
@@ -330,35 +505,52 @@ def extract_keywords_with_tfidf(text):
     scores = [tfidf_scores[i] for i in sorted_indices]
     return keywords, scores
 
-# New route to get all images
+# Paginated listing of all images, served from the images table
 @app.route('/all_images', methods=['GET'])
 def get_all_images():
+    """
+    Streams one page of images as JSON lines, in stable id order.
+    Query parameters: cursor (id of the last image of the previous page, default 0),
+    limit (default 100, at most 1000) and thumbnail_size.
+    Each line is {"id", "filename", "thumbnail"}; the last line is {"next_cursor"},
+    which is null after the last page.
+    """
     try:
-        image_files = [f for f in os.listdir(UPLOAD_FOLDER) if os.path.isfile(os.path.join(UPLOAD_FOLDER, f))]
-        images_data = []
-        filenames = []
-
-        for filename in image_files:
-            try:
-                with Image.open(os.path.join(UPLOAD_FOLDER, filename)) as img:
-                    buffered = BytesIO()
-                    img.save(buffered, format='JPEG')
-                    image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                    images_data.append(image_base64)
-                    filenames.append(filename)
-            except (FileNotFoundError, OSError) as e: # Catch OSError for non-image files
-                logging.warning(f"Could not open or read image file: {filename} - {e}")
-                continue  # Skip to the next file
-            except Exception as e:
-                logging.error(f"Error processing image {filename}: {e}")
-                continue
-
-        return jsonify({'images': images_data, 'filenames': filenames}), 200
-
+        cursor = request.args.get('cursor', 0, type=int)
+        limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        thumbnail_size = request.args.get('thumbnail_size', DEFAULT_THUMBNAIL_SIZE, type=int)
+        rows = db_manager.list_images(cursor, limit + 1)  # One extra to know if there is a next page
     except Exception as e:
         logging.error(f"Error retrieving all images: {str(e)}")
         return jsonify({'error': 'Failed to fetch all images'}), 500
 
+    def generate():
+        for image_id, filename in rows[:limit]:
+            yield json.dumps({'id': image_id, 'filename': filename,
+                              'thumbnail': thumbnail_url(filename, thumbnail_size)}) + '\n'
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        yield json.dumps({'next_cursor': next_cursor}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def backfill_image_index():
+    """
+    Register files stored before the images table existed. Runs once at startup.
+    """
+    known = {row[0] for row in db_manager.fetch_query_results("SELECT filename FROM images")}
+    missing = sorted(entry.name for entry in os.scandir(UPLOAD_FOLDER)
+                     if entry.is_file() and not entry.name.startswith('.') and entry.name not in known)
+    if missing:
+        db_manager.register_images((filename, None, os.path.getsize(os.path.join(UPLOAD_FOLDER, filename)), None, None)
+                                   for filename in missing)
+        logging.info(f"Added {len(missing)} existing file(s) to the image index")
+
+if SERVER_PROCESS:
+    backfill_image_index()
+
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # No reloader: it would run this module in a second process, with its own worker pool
+    # and job dispatcher claiming the same ingest tasks
+    app.run(debug=True, use_reloader=False)
\ No newline at end of file
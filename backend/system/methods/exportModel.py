@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from methods.getFeaturesCNN import PROCESSOR_PATH, MODEL_PATH
+from methods.modelRegistry import ModelRegistry, INFERENCE_BACKENDS, TORCHSCRIPT_FILE, ONNX_FILE, onnxruntime
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+class LogitsAndHiddenState(torch.nn.Module):
+    """The classifier with plain tensor outputs (logits, last hidden state), as exports need."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        outputs = self.model(pixel_values=pixel_values, output_hidden_states=True, return_dict=True)
+        return outputs.logits, outputs.hidden_states[-1]
+
+def export_torchscript(model, path, example):
+    with torch.no_grad():
+        traced = torch.jit.trace(LogitsAndHiddenState(model).eval(), example, strict=False)
+        traced = torch.jit.freeze(traced)  # Weights become constants, lets the JIT fold them
+    tmp_path = path + '.tmp'
+    traced.save(tmp_path)
+    os.replace(tmp_path, path)
+
+def export_onnx(model, path, example, opset=17):
+    batch_axis = {0: "batch"}
+    tmp_path = path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(LogitsAndHiddenState(model).eval(), (example,), tmp_path,
+                          input_names=["pixel_values"], output_names=["logits", "last_hidden_state"],
+                          dynamic_axes={"pixel_values": batch_axis, "logits": batch_axis, "last_hidden_state": batch_axis},
+                          opset_version=opset)
+    os.replace(tmp_path, path)
+
+def load_pixel_batches(processor, directory, limit, batch_size):
+    """
+    Preprocessed batches of up to `limit` images from directory (sorted by name).
+    :return: List of pixel_values tensors.
+    """
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    imgs = []
+    for name in names:
+        try:
+            imgs.append(Image.open(os.path.join(directory, name)).convert("RGB"))
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+    return [processor(images=imgs[start:start + batch_size], return_tensors="pt")["pixel_values"]
+            for start in range(0, len(imgs), batch_size)]
+
+def run_model(model, pixel_values):
+    with torch.no_grad():
+        outputs = model(pixel_values=pixel_values, output_hidden_states=True)
+    probabilities = torch.softmax(outputs.logits, dim=-1)
+    embeddings = torch.nn.functional.normalize(outputs.hidden_states[-1].mean(dim=1), dim=-1)  # As pooled_embeddings
+    return probabilities.numpy(), embeddings.numpy()
+
+def compare_top5(reference, candidate, batches):
+    """
+    Agreement of a backend with the fp32 model on the same inputs.
+    :return: Dict with top-1 agreement, mean top-5 overlap, largest probability difference
+             and the lowest cosine similarity of the pooled embeddings.
+    """
+    top1, overlap, max_diff, min_cosine, n = 0, 0.0, 0.0, 1.0, 0
+    for pixel_values in batches:
+        ref_probs, ref_embeddings = run_model(reference, pixel_values)
+        probs, embeddings = run_model(candidate, pixel_values)
+        ref_top5 = np.argsort(-ref_probs, axis=1)[:, :5]
+        top5 = np.argsort(-probs, axis=1)[:, :5]
+        for row in range(len(probs)):
+            top1 += int(ref_top5[row, 0] == top5[row, 0])
+            overlap += len(set(ref_top5[row]) & set(top5[row])) / 5
+        max_diff = max(max_diff, float(np.abs(ref_probs - probs).max()))
+        min_cosine = min(min_cosine, float((ref_embeddings * embeddings).sum(axis=1).min()))
+        n += len(probs)
+    if n == 0:
+        return {"images": 0}
+    return {"images": n, "top1_agreement": round(top1 / n, 4), "top5_overlap": round(overlap / n, 4),
+            "max_probability_diff": round(max_diff, 5), "min_embedding_cosine": round(min_cosine, 5)}
+
+def benchmark(model, batch_size=8, n_batches=10, warmup=2):
+    """
+    Forward-pass throughput on random inputs (each image of the ingest pipeline is 5 crops).
+    :return: Dict with images per second and milliseconds per image.
+    """
+    pixel_values = torch.randn(batch_size, 3, 224, 224)
+    for _ in range(warmup):
+        run_model(model, pixel_values)
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        run_model(model, pixel_values)
+    elapsed = time.perf_counter() - start
+    images = batch_size * n_batches
+    return {"images_per_second": round(images / elapsed, 2), "ms_per_image": round(elapsed / images * 1000, 2)}
+
+
+if __name__ == '__main__':
+    # One-time export, then accuracy and throughput of every available backend against fp32:
+    #   cd backend/system && python -m methods.exportModel --export all --images ../storage
+    # Select the backend of the server with CBIR_INFERENCE_BACKEND (pytorch, int8, torchscript, onnx).
+    parser = argparse.ArgumentParser(description="Export the ViT model and compare the inference backends")
+    parser.add_argument('--processor-path', default=PROCESSOR_PATH)
+    parser.add_argument('--model-path', default=MODEL_PATH)
+    parser.add_argument('--export', choices=('torchscript', 'onnx', 'all', 'none'), default='all')
+    parser.add_argument('--opset', type=int, default=17, help="ONNX opset version")
+    parser.add_argument('--images', default=os.path.join(BACKEND_DIR, 'storage'), help="Images for the top-5 comparison")
+    parser.add_argument('--limit', type=int, default=64, help="Images compared at most")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--batches', type=int, default=10, help="Timed batches per backend")
+    args = parser.parse_args()
+
+    reference = ModelRegistry(args.processor_path, args.model_path, 'pytorch')
+    processor, fp32_model = reference.load()
+    example = torch.randn(2, 3, 224, 224)
+    if args.export in ('torchscript', 'all'):
+        export_torchscript(fp32_model, os.path.join(args.model_path, TORCHSCRIPT_FILE), example)
+        print(f"Wrote {os.path.join(args.model_path, TORCHSCRIPT_FILE)}")
+    if args.export in ('onnx', 'all'):
+        export_onnx(fp32_model, os.path.join(args.model_path, ONNX_FILE), example, args.opset)
+        print(f"Wrote {os.path.join(args.model_path, ONNX_FILE)}")
+
+    batches = load_pixel_batches(processor, args.images, args.limit, args.batch_size) if os.path.isdir(args.images) else []
+    if not batches:
+        print(f"No images in {args.images}, skipping the top-5 comparison", file=sys.stderr)
+
+    report = {}
+    for backend in INFERENCE_BACKENDS:
+        if backend == 'torchscript' and not os.path.exists(os.path.join(args.model_path, TORCHSCRIPT_FILE)):
+            continue
+        if backend == 'onnx' and (onnxruntime is None or not os.path.exists(os.path.join(args.model_path, ONNX_FILE))):
+            continue
+        _, model = (reference if backend == 'pytorch' else ModelRegistry(args.processor_path, args.model_path, backend)).load()
+        report[backend] = {"benchmark": benchmark(model, args.batch_size, args.batches)}
+        if batches and backend != 'pytorch':
+            report[backend]["accuracy_vs_fp32"] = compare_top5(fp32_model, model, batches)
+    print(json.dumps(report, indent=2))
@@ -1,96 +1,212 @@
 import cv2
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+MAX_DOMINANT_PIXELS = 250_000  # Pixels sampled for dominant colors, whatever the resolution
+PALETTE_BITS = 5  # Bits kept per channel by the histogram-quantized palette (32 levels)
+
+# Joint H/S/V histogram: every hue, saturation and value in 16 steps each
+HUE_BINS = 180
+SV_BINS = 16
+SV_STEP = 256 // SV_BINS
+
+# Basic color ranges (Hue values, inclusive) for chromatic pixels
+BASIC_COLOR_RANGES = {
+    "Red": [(0, 10), (161, 179)],  # Two ranges for red
+    "Orange": [(11, 25)],
+    "Yellow": [(26, 35)],
+    "Green": [(36, 85)],
+    "Blue": [(86, 125)],
+    "Purple": [(126, 145)],
+    "Brown": [(146, 160)],
+}
+# Achromatic pixels are classified by value and saturation instead of hue
+BLACK_MAX_VALUE = 48       # Darker than this is Black, whatever the hue
+GRAY_MAX_SATURATION = 32   # Less saturated than this is Gray, or White if bright
+WHITE_MIN_VALUE = 192
+DARK_MAX_VALUE = 128       # Chromatic pixels darker than this are the "Dark" shade
+ACHROMATIC_COLOR_NAMES = ["Black", "White", "Gray"]
+
+BASIC_COLOR_NAMES = list(BASIC_COLOR_RANGES) + ACHROMATIC_COLOR_NAMES
+EXTENDED_COLOR_NAMES = [
+    "Light Red", "Dark Red", "Light Orange", "Dark Orange",
+    "Light Yellow", "Dark Yellow", "Light Green", "Dark Green",
+    "Light Blue", "Dark Blue", "Light Purple", "Dark Purple", "Brown"
+]
+
+def build_color_labels():
+    """
+    Lookup tables mapping every joint histogram bin to a basic and an extended color index.
+    Achromatic bins get no extended color (index len(EXTENDED_COLOR_NAMES), dropped later).
+    :return: (basic labels, extended labels), both flat arrays aligned with the flattened histogram.
+    """
+    hue_basic = np.zeros(HUE_BINS, dtype=np.int64)
+    for index, ranges in enumerate(BASIC_COLOR_RANGES.values()):
+        for low, high in ranges:
+            hue_basic[low:high + 1] = index
+
+    hue, sat, val = np.meshgrid(np.arange(HUE_BINS), np.arange(SV_BINS) * SV_STEP,
+                                np.arange(SV_BINS) * SV_STEP, indexing='ij')
+    basic = hue_basic[hue]
+    black = val < BLACK_MAX_VALUE
+    gray = ~black & (sat < GRAY_MAX_SATURATION)
+    white = gray & (val >= WHITE_MIN_VALUE)
+    basic[black] = BASIC_COLOR_NAMES.index("Black")
+    basic[gray] = BASIC_COLOR_NAMES.index("Gray")
+    basic[white] = BASIC_COLOR_NAMES.index("White")
+
+    # Extended: "Light"/"Dark" shade of the basic hue, Brown is a single shade
+    extended = np.full(basic.shape, len(EXTENDED_COLOR_NAMES), dtype=np.int64)
+    dark = val < DARK_MAX_VALUE
+    for index, color_name in enumerate(BASIC_COLOR_RANGES):
+        chromatic = (basic == index)
+        if color_name in EXTENDED_COLOR_NAMES:
+            extended[chromatic] = EXTENDED_COLOR_NAMES.index(color_name)
+        else:
+            extended[chromatic & ~dark] = EXTENDED_COLOR_NAMES.index(f"Light {color_name}")
+            extended[chromatic & dark] = EXTENDED_COLOR_NAMES.index(f"Dark {color_name}")
+    return basic.ravel(), extended.ravel()
+
+BASIC_LABELS, EXTENDED_LABELS = build_color_labels()
 
 class ImageColorAnalyzer:
-    def __init__(self, filename, num_clusters=5):
+    def __init__(self, filename, num_clusters=5, image_context=None,
+                 dominant_method="histogram", max_pixels=MAX_DOMINANT_PIXELS, random_state=0):
         """
         Initialize with image filename and number of clusters for dominant color detection.
         :param filename: path to the image
         :param num_clusters: number of dominant colors to detect using K-means (default: 5)
+        :param image_context: already decoded ImageContext of filename (optional, avoids decoding again)
+        :param dominant_method: "histogram" (weighted K-means over a quantized color histogram),
+                                "minibatch" (MiniBatchKMeans) or "kmeans" (plain K-means)
+        :param max_pixels: at most this many pixels are sampled for dominant colors (None uses all of them)
+        :param random_state: seed of the pixel sample and of K-means, so results are reproducible
         """
         self.filename = filename
-        self.image = cv2.imread(filename)
-        self.hsv_image = cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
+        if image_context is not None:
+            self.image = image_context.bgr  # Zero-copy view, BGR like cv2.imread
+            self.hsv_image = cv2.cvtColor(image_context.rgb, cv2.COLOR_RGB2HSV)
+        else:
+            self.image = cv2.imread(filename)
+            self.hsv_image = cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
         self.num_clusters = num_clusters
+        self.dominant_method = dominant_method
+        self.max_pixels = max_pixels
+        self.random_state = random_state
+
+        self.histogram = None  # Joint H/S/V histogram, computed once on first use
 
         # Define basic color ranges (Hue values) for fast analysis
-        self.basic_color_ranges = {
-            "Red": [(0, 10), (160, 180)],  # Two ranges for red
-            "Orange": [(11, 25)],
-            "Yellow": [(26, 35)],
-            "Green": [(36, 85)],
-            "Blue": [(86, 125)],
-            "Purple": [(126, 145)],
-            "Brown": [(146, 160)],
-            "Black": [(0, 180)],  # Full hue range with very low saturation and value
-            "White": [(0, 180)]   # Full hue range with very high value (brightness)
-        }
-        
+        self.basic_color_ranges = BASIC_COLOR_RANGES
+
         # Extended color palette (more detailed hues for deeper analysis)
-        self.extended_color_names = [
-            "Light Red", "Dark Red", "Light Orange", "Dark Orange",
-            "Light Yellow", "Dark Yellow", "Light Green", "Dark Green",
-            "Light Blue", "Dark Blue", "Light Purple", "Dark Purple", "Brown"
-        ]
+        self.extended_color_names = EXTENDED_COLOR_NAMES
 
     def calculate_histogram(self):
         """
-        Calculate and normalize the color histogram in the HSV color space.
-        :return: Flattened and normalized histogram.
+        Calculate the joint H/S/V histogram of the image (once, later calls reuse it).
+        :return: Histogram of shape (HUE_BINS, SV_BINS, SV_BINS) with pixel counts.
         """
-        hist = cv2.calcHist([self.hsv_image], [0], None, [180], [0, 180])
-        hist = cv2.normalize(hist, hist).flatten()
-        return hist
+        if self.histogram is None:
+            self.histogram = cv2.calcHist([self.hsv_image], [0, 1, 2], None,
+                                          [HUE_BINS, SV_BINS, SV_BINS], [0, 180, 0, 256, 0, 256])
+        return self.histogram
 
-    def analyze_colors_basic(self):
+    def palette_shares(self):
         """
-        Analyze the image using the basic color palette for a faster result.
-        :return: List of colors with their percentage in the image.
+        Share of the image in every basic and extended color, from one pass over the histogram.
+        :return: (basic shares, extended shares), aligned with BASIC_COLOR_NAMES and EXTENDED_COLOR_NAMES.
         """
-        hist = self.calculate_histogram()
-        total_pixels = np.sum(hist)
-        results = []
+        hist = self.calculate_histogram().ravel()
+        total_pixels = hist.sum()
+        if total_pixels == 0:
+            return np.zeros(len(BASIC_COLOR_NAMES)), np.zeros(len(EXTENDED_COLOR_NAMES))
+        basic = np.bincount(BASIC_LABELS, weights=hist, minlength=len(BASIC_COLOR_NAMES))
+        extended = np.bincount(EXTENDED_LABELS, weights=hist, minlength=len(EXTENDED_COLOR_NAMES) + 1)
+        return basic / total_pixels, extended[:len(EXTENDED_COLOR_NAMES)] / total_pixels
 
-        for color_name, ranges in self.basic_color_ranges.items():
-            color_percentage = 0
-            for (low, high) in ranges:
-                color_percentage += np.sum(hist[low:high + 1])
-
-            color_percentage = (color_percentage / total_pixels)
+    def color_results(self, names, shares):
+        results = []
+        for color_name, color_percentage in zip(names, shares):
             if color_percentage > 0:
                 results.append({
                     "filename": self.filename,
                     "feature_type": "Colors",
                     "feature_value": color_name,
-                    "probability": round(color_percentage, 2)
+                    "probability": round(float(color_percentage), 2)
                 })
-        
         return results
 
+    def analyze_colors_basic(self):
+        """
+        Analyze the image using the basic color palette for a faster result.
+        :return: List of colors with their percentage in the image.
+        """
+        basic, _ = self.palette_shares()
+        return self.color_results(BASIC_COLOR_NAMES, basic)
+
+    def sample_pixels(self):
+        """
+        Fixed-seed uniform sample of at most max_pixels pixels (all pixels for smaller images).
+        :return: (N, 3) array of BGR pixels.
+        """
+        height, width = self.image.shape[:2]
+        total = height * width
+        if self.max_pixels is None or total <= self.max_pixels:
+            return self.image.reshape(-1, 3)
+        rng = np.random.default_rng(self.random_state)
+        idx = np.sort(rng.integers(0, total, self.max_pixels))  # Sorted for memory locality
+        return self.image[idx // width, idx % width]
+
+    def quantized_palette(self, pixels):
+        """
+        Histogram of the pixels quantized to PALETTE_BITS per channel.
+        :return: (bin colors, pixel count per bin) of the non-empty bins.
+        """
+        shift = 8 - PALETTE_BITS
+        q = (pixels >> shift).astype(np.int64)
+        codes = (q[:, 0] << (2 * PALETTE_BITS)) | (q[:, 1] << PALETTE_BITS) | q[:, 2]
+        counts = np.bincount(codes, minlength=1 << (3 * PALETTE_BITS))
+        bins = np.flatnonzero(counts)
+        mask = (1 << PALETTE_BITS) - 1
+        levels = np.stack([bins >> (2 * PALETTE_BITS), (bins >> PALETTE_BITS) & mask, bins & mask], axis=1)
+        colors = (levels << shift) + (1 << (shift - 1))  # Bin centers
+        return colors.astype(np.float64), counts[bins]
+
     def analyze_dominant_colors(self):
         """
         Use K-means clustering to find the most dominant colors in the image.
+        Runs on a bounded pixel sample, so the cost does not grow with the resolution.
         :return: List of dominant colors with their percentages in the image.
         """
-        # Reshape image to a list of pixels
-        pixels = self.image.reshape(-1, 3)
-        
-        # Apply K-means clustering to find dominant colors
-        kmeans = KMeans(n_clusters=self.num_clusters)
-        kmeans.fit(pixels)
-        colors = kmeans.cluster_centers_.astype(int)
-        labels = kmeans.labels_
+        pixels = self.sample_pixels()
 
-        # Count the frequency of each cluster (color)
-        label_counts = np.bincount(labels)
-        total_count = len(labels)
+        if self.dominant_method == "histogram":
+            # Cluster the few thousand distinct palette bins, weighted by their pixel counts
+            points, weights = self.quantized_palette(pixels)
+            n_clusters = min(self.num_clusters, len(points))
+            kmeans = KMeans(n_clusters=n_clusters, n_init=4, random_state=self.random_state)
+            kmeans.fit(points, sample_weight=weights)
+            label_counts = np.bincount(kmeans.labels_, weights=weights, minlength=n_clusters)
+        else:
+            if self.dominant_method == "minibatch":
+                kmeans = MiniBatchKMeans(n_clusters=self.num_clusters, batch_size=4096, n_init=3,
+                                         random_state=self.random_state)
+            elif self.dominant_method == "kmeans":
+                kmeans = KMeans(n_clusters=self.num_clusters, random_state=self.random_state)
+            else:
+                raise ValueError(f"Unknown dominant color method: {self.dominant_method}")
+            kmeans.fit(pixels)
+            n_clusters = self.num_clusters
+            label_counts = np.bincount(kmeans.labels_, minlength=n_clusters)
+
+        colors = kmeans.cluster_centers_.astype(int)
 
         # Get color percentages
-        color_percentages = label_counts / total_count
+        color_percentages = label_counts / label_counts.sum()
 
         results = []
-        for i in range(self.num_clusters):
+        for i in range(n_clusters):
             color_value = colors[i].tolist()
             results.append({
                 "filename": self.filename,
@@ -104,25 +220,19 @@ class ImageColorAnalyzer:
     def analyze_colors_extended(self):
         """
         Analyze the image using an extended color palette for deeper color extraction.
-        :return: List of detailed color percentages.
+        Hues are split into light and dark shades, on top of the basic palette.
+        :return: List of basic and detailed color percentages.
         """
-        hist = self.calculate_histogram()
-        total_pixels = np.sum(hist)
-        results = []
-
-        # Extended color ranges can be set up in a similar way, or use clustering
-        # This is an area where you might define more nuanced hues
-
-        # Example: Just returning basic results (can be extended further)
-        results.extend(self.analyze_colors_basic())
-        
-        return results
+        basic, extended = self.palette_shares()
+        detailed = [(name, share) for name, share in zip(EXTENDED_COLOR_NAMES, extended)
+                    if name not in BASIC_COLOR_RANGES]  # Brown is already a basic color
+        return self.color_results(BASIC_COLOR_NAMES, basic) + self.color_results(*zip(*detailed))
 
     def full_color_analysis(self):
         """
-        Perform both basic and dominant color analysis for best performance.
-        :return: Combined list of basic and dominant colors.
+        Perform extended and dominant color analysis (both palettes come from one histogram).
+        :return: Combined list of palette and dominant colors.
         """
-        basic_colors = self.analyze_colors_basic()
+        palette_colors = self.analyze_colors_extended()
         dominant_colors = self.analyze_dominant_colors()
-        return basic_colors + dominant_colors
\ No newline at end of file
+        return palette_colors + dominant_colors
@@ -1,25 +1,26 @@
-from transformers import AutoImageProcessor, AutoModelForImageClassification
+from methods.modelRegistry import get_model_registry, INFERENCE_BACKEND
 import torch
 from PIL import Image
-import os
+import numpy as np
+
+# Default model locations, see README "Add your model path"
+PROCESSOR_PATH = 'Model Preprocessor Path'
+MODEL_PATH = 'Model Path'
 
 class ImageFeatureExtractor:
     def __init__(self, 
                  process_top_features,
-                 processor_path='Model Preprocessor Path', 
-                 model_path='Model Path', 
-                 predictionUpto=5):
-        # Check if the processor and model paths exist
-        if not os.path.exists(processor_path):
-            raise FileNotFoundError(f"Processor path not found: {processor_path}")
-        if not os.path.exists(model_path):
-            raise FileNotFoundError(f"Model path not found: {model_path}")
-
-        # Load processor and model using Auto classes
-        self.processor = AutoImageProcessor.from_pretrained(processor_path)
-        self.model = AutoModelForImageClassification.from_pretrained(model_path)
+                 processor_path=PROCESSOR_PATH, 
+                 model_path=MODEL_PATH, 
+                 predictionUpto=5,
+                 batch_size=8,
+                 backend=INFERENCE_BACKEND):
+        # Processor and model are loaded once per process and shared by every extractor
+        self.registry = get_model_registry(processor_path, model_path, backend)
+        self.processor, self.model = self.registry.load()
         self.predictionUpto = predictionUpto
         self.process_top_features = process_top_features
+        self.batch_size = batch_size  # Images per forward pass (each image adds 5 crops)
 
     def split_multiword_features(self, feature_data):
         processed_data = []
@@ -35,29 +36,64 @@ class ImageFeatureExtractor:
                 })
         return processed_data
 
-    def extract_features_from_image(self, img, filename, region_name="Original"):
-        inputs = self.processor(images=img, return_tensors="pt")
-        
+    def pooled_embeddings(self, outputs):
+        """
+        Mean of the last hidden state over all tokens, L2-normalized (so dot product = cosine).
+        :return: float32 array of shape (batch, hidden_size).
+        """
+        pooled = outputs.hidden_states[-1].mean(dim=1)
+        pooled = torch.nn.functional.normalize(pooled, dim=-1)
+        return pooled.numpy().astype(np.float32)
+
+    def extract_features_from_batch(self, imgs, filenames, region_names, return_embeddings=False):
+        """
+        Run a single forward pass over a list of images (originals and/or crops).
+        :param return_embeddings: Also return the pooled embedding of every input image
+        :return: One top-k feature list per input image, in input order
+                 (and an array of embeddings, one row per input image, if return_embeddings).
+        """
+        inputs = self.processor(images=imgs, return_tensors="pt")
+
         with torch.no_grad():  # Disable gradient calculation
-            outputs = self.model(**inputs)
+            outputs = self.model(**inputs, output_hidden_states=return_embeddings)
         logits = outputs.logits
 
-        probabilities = torch.softmax(logits, dim=-1)[0]
-        top5_prob, top5_catid = torch.topk(probabilities, self.predictionUpto)
-
-        feature_list = []
-        for i in range(top5_prob.size(0)):
-            feature_list.append({
-                "filename": filename,
-                "region": region_name,
-                "feature_type": "Image classification",
-                "feature_value": self.model.config.id2label[top5_catid[i].item()],
-                "probability": round(top5_prob[i].item(), 4)
-            })
+        probabilities = torch.softmax(logits, dim=-1)
+        top_prob, top_catid = torch.topk(probabilities, self.predictionUpto, dim=-1)
+        top_prob = top_prob.tolist()
+        top_catid = top_catid.tolist()
+
+        batch_features = []
+        for row, (filename, region_name) in enumerate(zip(filenames, region_names)):
+            feature_list = []
+            for prob, catid in zip(top_prob[row], top_catid[row]):
+                feature_list.append({
+                    "filename": filename,
+                    "region": region_name,
+                    "feature_type": "Image classification",
+                    "feature_value": self.model.config.id2label[catid],
+                    "probability": round(prob, 4)
+                })
+            batch_features.append(feature_list)
+        if return_embeddings:
+            return batch_features, self.pooled_embeddings(outputs)
+        return batch_features
 
-        return feature_list
+    def extract_features_from_image(self, img, filename, region_name="Original"):
+        return self.extract_features_from_batch([img], [filename], [region_name])[0]
 
     def get_quadrant_images(self, img):
+        if isinstance(img, np.ndarray):
+            # Pixel array (H x W x 3): the crops are views, nothing is copied
+            height, width = img.shape[:2]
+            mid_x, mid_y = width // 2, height // 2
+            return {
+                "Top Left": img[0:mid_y, 0:mid_x],
+                "Top Right": img[0:mid_y, mid_x:width],
+                "Bottom Left": img[mid_y:height, 0:mid_x],
+                "Bottom Right": img[mid_y:height, mid_x:width],
+            }
+
         width, height = img.size
         mid_x, mid_y = width // 2, height // 2
 
@@ -82,22 +118,14 @@ class ImageFeatureExtractor:
     def filter_low_probabilities(self, processed_feature_list, threshold=0.0005):
         return [feature for feature in processed_feature_list if feature['probability'] >= threshold]
 
-    def get_features(self, filename):
-        try:
-            img = Image.open(filename).convert("RGB")
-        except Exception as e:
-            print(f"Error opening image {filename}: {e}")
-            return []
-
-        # Extract features from the original image
-        original_features = self.extract_features_from_image(img, filename, "Original")
-
-        # Get features from quadrants
-        quadrants = self.get_quadrant_images(img)
+    def combine_features(self, original_features, quadrant_features):
+        """
+        Merge the original and per-quadrant predictions of one image into its final feature list.
+        :param quadrant_features: Dict of quadrant name -> feature list
+        """
         all_features = original_features.copy()
-        for quadrant_name, quadrant_img in quadrants.items():
-            quadrant_features = self.extract_features_from_image(quadrant_img, filename, quadrant_name)
-            adjusted_quadrant_features = self.adjust_probabilities(original_features, quadrant_features)
+        for quadrant_name, features in quadrant_features.items():
+            adjusted_quadrant_features = self.adjust_probabilities(original_features, features)
             all_features += adjusted_quadrant_features
 
         processed_feature_list = self.split_multiword_features(all_features)
@@ -106,4 +134,85 @@ class ImageFeatureExtractor:
         # Combine processed features
         processed_feature_list_added = processed_feature_list + processed_feature_list_extra
         processed_feature_list_added = self.filter_low_probabilities(processed_feature_list_added)
-        return processed_feature_list_added
\ No newline at end of file
+        return processed_feature_list_added
+
+    def get_features_batch(self, filenames, batch_size=None, image_contexts=None, return_embeddings=False):
+        """
+        Extract features for many images, batching the original and the four quadrant
+        crops of up to batch_size images into one forward pass.
+        :param image_contexts: Optional list of already decoded ImageContexts (or None), aligned with filenames
+        :param return_embeddings: Also return the float16 embedding of every whole image
+        :return: One feature list per filename, in input order ([] if the image could not be opened),
+                 and with return_embeddings a list of embeddings (None if the image could not be opened).
+        """
+        batch_size = batch_size or self.batch_size
+        image_contexts = image_contexts or [None] * len(filenames)
+        results = []
+        embeddings = []
+        for start in range(0, len(filenames), batch_size):
+            chunk = filenames[start:start + batch_size]
+            chunk_contexts = image_contexts[start:start + batch_size]
+
+            imgs, crop_filenames, crop_regions = [], [], []
+            opened = []
+            for filename, image_context in zip(chunk, chunk_contexts):
+                if image_context is not None:
+                    img = image_context.rgb  # Already decoded, shared read-only
+                else:
+                    try:
+                        img = Image.open(filename).convert("RGB")
+                    except Exception as e:
+                        print(f"Error opening image {filename}: {e}")
+                        continue
+                opened.append(filename)
+                imgs.append(img)
+                crop_filenames.append(filename)
+                crop_regions.append("Original")
+                for quadrant_name, quadrant_img in self.get_quadrant_images(img).items():
+                    imgs.append(quadrant_img)
+                    crop_filenames.append(filename)
+                    crop_regions.append(quadrant_name)
+
+            batch_features, batch_embeddings = [], None
+            if imgs:
+                if return_embeddings:
+                    batch_features, batch_embeddings = self.extract_features_from_batch(
+                        imgs, crop_filenames, crop_regions, return_embeddings=True)
+                else:
+                    batch_features = self.extract_features_from_batch(imgs, crop_filenames, crop_regions)
+
+            # Every opened image contributes 5 consecutive rows: Original + 4 quadrants
+            features_by_file = {}
+            embedding_by_file = {}
+            for i, filename in enumerate(opened):
+                rows = batch_features[i * 5:(i + 1) * 5]
+                quadrant_features = {crop_regions[i * 5 + j]: rows[j] for j in range(1, 5)}
+                features_by_file[filename] = self.combine_features(rows[0], quadrant_features)
+                if batch_embeddings is not None:
+                    embedding_by_file[filename] = batch_embeddings[i * 5].astype(np.float16)  # Original only
+
+            results.extend(features_by_file.get(filename, []) for filename in chunk)
+            embeddings.extend(embedding_by_file.get(filename) for filename in chunk)
+        if return_embeddings:
+            return results, embeddings
+        return results
+
+    def get_features(self, filename, image_context=None, return_embedding=False):
+        if return_embedding:
+            features, embeddings = self.get_features_batch([filename], image_contexts=[image_context], return_embeddings=True)
+            return features[0], embeddings[0]
+        return self.get_features_batch([filename], image_contexts=[image_context])[0]
+
+    def get_embeddings(self, imgs):
+        """
+        Pooled embeddings of whole images only (no quadrant crops), e.g. for query-by-example.
+        :param imgs: PIL images or RGB arrays
+        :return: float32 array of shape (len(imgs), hidden_size), rows L2-normalized.
+        """
+        embeddings = []
+        for start in range(0, len(imgs), self.batch_size * 5):
+            chunk = imgs[start:start + self.batch_size * 5]
+            _, chunk_embeddings = self.extract_features_from_batch(
+                chunk, [None] * len(chunk), ["Original"] * len(chunk), return_embeddings=True)
+            embeddings.append(chunk_embeddings)
+        return np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
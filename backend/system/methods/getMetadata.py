@@ -35,11 +35,14 @@ from PIL.ExifTags import TAGS, GPSTAGS
 import os
 import pandas as pd
 
-def GetMetadata(imagelink):
+def GetMetadata(imagelink, image_context=None):
+    """
+    :param image_context: already decoded ImageContext of imagelink (optional, avoids opening the file again)
+    """
     metadata = []
     try:
-        # Open image
-        image = Image.open(imagelink)
+        # Open image (the context exposes the same format/size/mode/info attributes)
+        image = image_context if image_context is not None else Image.open(imagelink)
         
         # File Information
         metadata.append({
@@ -62,7 +65,7 @@ def GetMetadata(imagelink):
         })
         
         # EXIF Data
-        exif_data = image._getexif()
+        exif_data = image_context.exif if image_context is not None else image._getexif()
         if exif_data:
             for tag, value in exif_data.items():
                 tag_name = TAGS.get(tag, tag)
@@ -0,0 +1,197 @@
+from transformers import AutoConfig, AutoImageProcessor, AutoModelForImageClassification
+from types import SimpleNamespace
+import torch
+import threading
+import time
+import os
+import sys
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, fall back to the stdlib where possible
+    psutil = None
+
+try:
+    import onnxruntime
+except ImportError:  # onnxruntime is only needed for the 'onnx' backend
+    onnxruntime = None
+
+# Inference backends: fp32 eager PyTorch, dynamic int8 quantized PyTorch (Linear layers),
+# or a model exported by `python -m methods.exportModel` (TorchScript or ONNX)
+INFERENCE_BACKENDS = ('pytorch', 'int8', 'torchscript', 'onnx')
+INFERENCE_BACKEND = os.environ.get('CBIR_INFERENCE_BACKEND', 'pytorch')
+TORCHSCRIPT_FILE = 'model.torchscript.pt'  # Written into the model directory
+ONNX_FILE = 'model.onnx'
+
+
+def get_resident_memory_mb():
+    """
+    Return the resident memory of this process in MB (None if it cannot be measured).
+    Uses psutil when installed, otherwise /proc on Linux or getrusage elsewhere.
+    """
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB on Linux
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        return None
+
+
+def limit_torch_threads(n_threads):
+    """
+    Cap PyTorch's intra-op threads in this process. With several inference workers on one
+    machine, each should use its share of the cores instead of all of them.
+    """
+    if n_threads and torch.get_num_threads() != n_threads:
+        torch.set_num_threads(n_threads)
+
+
+class ExportedModel:
+    def __init__(self, run, config):
+        """
+        Exported model with the call signature of the Hugging Face model used by ImageFeatureExtractor.
+        Exports have two outputs, the logits and the last hidden state, so hidden_states only
+        holds the last layer (all that pooled embeddings use).
+        :param run: Function of a pixel_values tensor returning (logits, last hidden state) tensors
+        :param config: Model config, for id2label
+        """
+        self.run = run
+        self.config = config
+
+    def __call__(self, pixel_values, output_hidden_states=False, **kwargs):
+        logits, last_hidden_state = self.run(pixel_values)
+        return SimpleNamespace(logits=logits, hidden_states=(last_hidden_state,) if output_hidden_states else None)
+
+def onnx_runner(path):
+    if onnxruntime is None:
+        raise ImportError("The 'onnx' inference backend needs onnxruntime (pip install onnxruntime)")
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()  # Same thread budget as PyTorch in this process
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def run(pixel_values):
+        logits, last_hidden_state = session.run(None, {"pixel_values": pixel_values.numpy()})
+        return torch.from_numpy(logits), torch.from_numpy(last_hidden_state)
+    return run
+
+
+class ModelRegistry:
+    def __init__(self, processor_path, model_path, backend=INFERENCE_BACKEND):
+        """
+        Holds one processor/model pair per process, shared read-only by every worker.
+        :param processor_path: path of the pretrained image processor
+        :param model_path: path of the pretrained classification model
+        :param backend: one of INFERENCE_BACKENDS; 'torchscript' and 'onnx' need the files written
+                        by methods/exportModel.py in the model directory
+        """
+        if backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend}")
+        self.processor_path = processor_path
+        self.model_path = model_path
+        self.backend = backend
+        self.processor = None
+        self.model = None
+        self.load_time = None
+        self.memory_before_mb = None
+        self.memory_after_mb = None
+        self.warmed_up = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the processor and model once. Concurrent callers wait for the first load.
+        :return: (processor, model)
+        """
+        if self.model is not None:
+            return self.processor, self.model
+
+        with self.lock:
+            if self.model is None:
+                if not os.path.exists(self.processor_path):
+                    raise FileNotFoundError(f"Processor path not found: {self.processor_path}")
+                if not os.path.exists(self.model_path):
+                    raise FileNotFoundError(f"Model path not found: {self.model_path}")
+
+                self.memory_before_mb = get_resident_memory_mb()
+                start = time.perf_counter()
+                processor = AutoImageProcessor.from_pretrained(self.processor_path)
+                model = self._load_model()
+                self.load_time = time.perf_counter() - start
+                self.memory_after_mb = get_resident_memory_mb()
+
+                self.processor = processor
+                self.model = model
+                print(f"Model loaded from {self.model_path} ({self.backend}) in {self.load_time:.2f}s "
+                      f"(resident memory: {self._format_mb(self.memory_after_mb)})")
+        return self.processor, self.model
+
+    def _load_model(self):
+        if self.backend in ('pytorch', 'int8'):
+            model = AutoModelForImageClassification.from_pretrained(self.model_path)
+            model.eval()  # Inference only, weights are never modified
+            if self.backend == 'int8':
+                # int8 weights, activations quantized on the fly; the Linear layers are most of ViT's cost
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            return model
+
+        filename = TORCHSCRIPT_FILE if self.backend == 'torchscript' else ONNX_FILE
+        path = os.path.join(self.model_path, filename)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found, export it with: python -m methods.exportModel --backend {self.backend}")
+        config = AutoConfig.from_pretrained(self.model_path)
+        if self.backend == 'torchscript':
+            return ExportedModel(torch.jit.load(path).eval(), config)
+        return ExportedModel(onnx_runner(path), config)
+
+    def warmup(self):
+        """
+        Load the model and run one dummy forward pass so the first request does not pay for it.
+        """
+        processor, model = self.load()
+        with self.lock:
+            if self.warmed_up:
+                return
+            dummy = torch.zeros((1, 3, 224, 224))
+            with torch.no_grad():
+                model(pixel_values=dummy)
+            self.warmed_up = True
+
+    def stats(self):
+        """
+        :return: Dict with the load time (seconds) and resident memory (MB) of this process.
+        """
+        return {
+            "model_path": self.model_path,
+            "backend": self.backend,
+            "loaded": self.model is not None,
+            "warmed_up": self.warmed_up,
+            "load_time_seconds": self.load_time,
+            "memory_before_load_mb": self.memory_before_mb,
+            "memory_after_load_mb": self.memory_after_mb,
+            "resident_memory_mb": get_resident_memory_mb(),
+        }
+
+    @staticmethod
+    def _format_mb(value):
+        return f"{value:.0f} MB" if value is not None else "unknown"
+
+
+# One registry per (processor_path, model_path, backend) in this process
+_registries = {}
+_registries_lock = threading.Lock()
+
+def get_model_registry(processor_path, model_path, backend=INFERENCE_BACKEND):
+    key = (processor_path, model_path, backend)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ModelRegistry(processor_path, model_path, backend)
+        return _registries[key]
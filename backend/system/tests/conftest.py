@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules import each other relative to backend/system, as when main.py runs
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
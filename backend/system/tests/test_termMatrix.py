@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from Retrieval.termMatrix import TermMatrix, QUERY_TERM_WEIGHT, OTHER_TERM_WEIGHT
+
+def random_term_matrix(tmp_path, n_images=400, n_terms=60, seed=0):
+    """Term matrix over random features, with a skewed (Zipf-like) term distribution."""
+    rng = np.random.default_rng(seed)
+    term_probs = 1.0 / np.arange(1, n_terms + 1)
+    term_probs /= term_probs.sum()
+    rows = []
+    for image in range(n_images):
+        terms = rng.choice(n_terms, size=rng.integers(1, 12), replace=False, p=term_probs)
+        rows.extend((f"img{image}.jpg", f"term{term}", float(rng.random())) for term in terms)
+    term_matrix = TermMatrix(db_manager=None, path=str(tmp_path / "term_matrix"))
+    term_matrix._stage_rows(rows, replace=False)
+    return term_matrix, rows
+
+def dense_scores(rows, included_words, all_query_terms):
+    """Cosine similarities computed directly from the feature rows."""
+    images = {}
+    for filename, term, probability in rows:
+        images.setdefault(filename, {}).setdefault(term, probability)
+    query = {term: QUERY_TERM_WEIGHT if term in included_words else OTHER_TERM_WEIGHT for term in all_query_terms}
+    query_norm = np.sqrt(sum(weight * weight for weight in query.values()))
+    scores = {}
+    for filename, features in images.items():
+        if not set(features) & set(query):
+            continue
+        vector = {term: probability * query.get(term, OTHER_TERM_WEIGHT) for term, probability in features.items()}
+        dot = sum(value * query[term] for term, value in vector.items() if term in query)
+        scores[filename] = dot / (np.sqrt(sum(value * value for value in vector.values())) * query_norm)
+    return scores
+
+@pytest.mark.parametrize("seed", range(5))
+def test_score_matches_dense_cosine(tmp_path, seed):
+    term_matrix, rows = random_term_matrix(tmp_path, seed=seed)
+    included, terms = ["term0", "term7"], ["term0", "term7", "term3", "term25"]
+    filenames, scores = term_matrix.score(included, terms)
+    expected = dense_scores(rows, included, terms)
+    assert sorted(filenames) == sorted(expected)
+    for filename, score in zip(filenames, scores):
+        assert score == pytest.approx(expected[filename])
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("k", [1, 10, 50, 10000])
+def test_top_k_matches_sorted_score(tmp_path, seed, k):
+    term_matrix, _ = random_term_matrix(tmp_path, seed=seed)
+    included, terms = ["term1"], ["term1", "term2", "term40"]
+    filenames, scores = term_matrix.score(included, terms)
+    top = term_matrix.top_k(included, terms, k)
+
+    expected = sorted(scores, reverse=True)[:k]
+    assert [score for _, score in top] == pytest.approx(expected)
+    score_of = dict(zip(filenames, scores))
+    assert all(score_of[filename] == pytest.approx(score) for filename, score in top)
+
+def test_top_k_without_matches(tmp_path):
+    term_matrix, _ = random_term_matrix(tmp_path)
+    assert term_matrix.top_k(["unknown"], ["unknown"], 10) == []
+    assert term_matrix.top_k(["term0"], ["term0"], 0) == []
+
+def restaged(rows, filenames, rng, n_terms=60):
+    """rows with the features of filenames replaced by new random ones (none for every third)."""
+    kept = [row for row in rows if row[0] not in filenames]
+    new = []
+    for i, filename in enumerate(sorted(filenames)):
+        if i % 3:
+            terms = rng.choice(n_terms + 5, size=rng.integers(1, 8), replace=False)  # May add new terms
+            new.extend((filename, f"term{term}", float(rng.random())) for term in terms)
+    return kept + new, new
+
+@pytest.mark.parametrize("seed", range(3))
+def test_delta_overrides_merged_base(tmp_path, seed):
+    term_matrix, rows = random_term_matrix(tmp_path, seed=seed)
+    term_matrix.merge()
+    assert not term_matrix.delta_rows and term_matrix.matrix.nnz > 0
+
+    rng = np.random.default_rng(seed)
+    changed = {f"img{image}.jpg" for image in rng.choice(400, size=30, replace=False)} | {"new0.jpg", "new1.jpg"}
+    rows, new = restaged(rows, changed, rng)
+    for filename in changed:
+        if filename in term_matrix.row_of:
+            term_matrix.delta_rows[term_matrix.row_of[filename]] = {}
+    term_matrix._stage_rows(new)
+
+    included, terms = ["term0", "term62"], ["term0", "term62", "term3", "term9"]
+    expected = dense_scores(rows, included, terms)
+    for _ in range(2):  # Base + delta, then everything merged
+        filenames, scores = term_matrix.score(included, terms)
+        assert sorted(filenames) == sorted(expected)
+        for filename, score in zip(filenames, scores):
+            assert score == pytest.approx(expected[filename])
+        term_matrix.merge()
+    assert not term_matrix.delta_rows
+
+def test_merge_keeps_rows_staged_meanwhile(tmp_path):
+    term_matrix, _ = random_term_matrix(tmp_path)
+    row = term_matrix.row_of["img0.jpg"]
+    original = dict(term_matrix.delta_rows)
+    term_matrix.delta_rows[row] = {term_matrix.col_of["term0"]: 0.5}  # Staged again after the merge took its snapshot
+    merged = TermMatrix._merged(term_matrix.matrix, original, len(term_matrix.filenames), len(term_matrix.terms))
+
+    # Install the merge the way merge() does: only unchanged delta rows leave the delta
+    term_matrix.matrix = merged
+    for staged_row, values in original.items():
+        if term_matrix.delta_rows.get(staged_row) is values:
+            del term_matrix.delta_rows[staged_row]
+    term_matrix.delta_dirty = True
+    assert list(term_matrix.delta_rows) == [row]
+    filenames, scores = term_matrix.score(["term0"], ["term0"])
+    assert dict(zip(filenames, scores))["img0.jpg"] == pytest.approx(1.0)
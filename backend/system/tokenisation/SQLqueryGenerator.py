@@ -1,6 +1,5 @@
-import nltk
-from nltk.corpus import wordnet
 from autocorrect import Speller  # Use Speller from autocorrect
+from tokenisation.synonymService import get_synonym_service
 
 # nltk.download('wordnet') # commented as it was downloaded in worknetExtraction
 
@@ -27,12 +26,7 @@ class SQLQueryGenerator:
         # Generate a list of synonyms for each included word
         synonyms = []
         for word in self.included_words:
-            syns = wordnet.synsets(word)
-            word_synonyms = set()
-            for syn in syns:
-                for lemma in syn.lemmas():
-                    word_synonyms.add(lemma.name())  # Collect synonyms
-            synonyms.extend(word_synonyms)
+            synonyms.extend(get_synonym_service().get_synonyms(word))  # Collect synonyms
         return self.included_words + list(synonyms)   # Include the original words
 
     def generate_query(self):
@@ -41,7 +35,7 @@ class SQLQueryGenerator:
         self.included_words = self.get_query_synonyms()  # Get synonyms after parsing
         
         # Construct the SQL query
-        self.sql_query = "SELECT * FROM Imagefeatures WHERE ("
+        self.sql_query = "SELECT * FROM image_features WHERE ("
 
         # Include feature_value conditions
         if self.included_words:
@@ -2,6 +2,8 @@
 import spacy
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
+from collections import OrderedDict
+import threading
 import re
 import nltk
 
@@ -9,21 +11,28 @@ import nltk
 nltk.download('stopwords')
 
 class SentenceConverter:
-    def __init__(self):
-        # Initialize spaCy model and other necessary components
-        self.nlp = spacy.load('en_core_web_sm')
+    def __init__(self, cache_size=1024):
+        # Only the tokenizer is needed, so skip loading the tagger/parser/NER pipeline
+        self.nlp = spacy.blank('en')
         self.ps = PorterStemmer()
         self.stop_words = set(stopwords.words('english'))
         self.negation_words = [
-            'without', 'no', 'not', 'never', 'none', 'nobody', 'nothing', 
-            'neither', 'nor', 'nowhere', 'hardly', 'barely', 'scarcely', 
-            'except', 'excluding', 'but', 'minus', 'avoid', 'lack', 'absent', 
+            'without', 'no', 'not', 'never', 'none', 'nobody', 'nothing',
+            'neither', 'nor', 'nowhere', 'hardly', 'barely', 'scarcely',
+            'except', 'excluding', 'but', 'minus', 'avoid', 'lack', 'absent',
             'denied', 'prohibited', 'devoid', 'omit', 'forbid'
         ]
 
+        # LRU cache: normalized query -> (included words, excluded words)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.lock = threading.Lock()
+
     def convert_to_query(self, sentence):
         # Tokenize and process the sentence
-        doc = self.nlp(sentence.lower())
+        doc = self.nlp.make_doc(sentence.lower())
 
         included_words = []
         excluded_words = []
@@ -35,11 +44,64 @@ class SentenceConverter:
                 next_word = doc[i + 1] if i + 1 < len(doc) else None
                 if next_word and next_word.text not in self.stop_words:  # Ensure it's not a stopword
                     stemmed_word = self.ps.stem(next_word.text)
-                    excluded_words.append((next_word.text, f"-{stemmed_word}"))  # Include original and stemmed
+                    excluded_words.append(f"-{next_word.text} -{stemmed_word}")  # Include original and stemmed
                     negated_words.add(next_word.text)
             elif token.text not in self.stop_words and token.text not in negated_words:
                 stemmed_word = self.ps.stem(token.text)
                 included_words.append(token.text+" "+stemmed_word)  # Include original and stemmed
 
         # Construct and return the final query
-        return ' '.join(included_words + excluded_words)
\ No newline at end of file
+        return ' '.join(included_words + excluded_words)
+
+    @staticmethod
+    def normalize(sentence):
+        return re.sub(r'\s+', ' ', sentence.strip().lower())
+
+    def parse_query(self, sentence):
+        """
+        Split a sentence into included and excluded query terms, using the LRU cache.
+        :return: (included_words, excluded_words), each a new list.
+        """
+        key = self.normalize(sentence)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                included_words, excluded_words = self.cache[key]
+                return list(included_words), list(excluded_words)
+            self.cache_misses += 1
+
+        processed_query = self.convert_to_query(key)
+        included_words = tuple(word for word in processed_query.split() if not word.startswith("-"))
+        excluded_words = tuple(word[1:] for word in processed_query.split() if word.startswith("-"))
+
+        with self.lock:
+            self.cache[key] = (included_words, excluded_words)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)  # Drop the least recently used query
+        return list(included_words), list(excluded_words)
+
+    def cache_stats(self):
+        with self.lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "size": len(self.cache),
+                "max_size": self.cache_size,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            }
+
+
+# One converter (and spaCy pipeline) per process
+_converter = None
+_converter_lock = threading.Lock()
+
+def get_sentence_converter():
+    global _converter
+    if _converter is None:
+        with _converter_lock:
+            if _converter is None:
+                _converter = SentenceConverter()
+    return _converter
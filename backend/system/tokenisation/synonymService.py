@@ -0,0 +1,131 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from nltk.corpus import wordnet
+
+# Optional precomputed word -> synonyms table (see build_synonym_table below)
+SYNONYM_TABLE_PATH = os.environ.get(
+    'CBIR_SYNONYM_TABLE',
+    os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'synonym_table.json'))
+)
+
+class SynonymService:
+    def __init__(self, cache_size=4096, table_path=SYNONYM_TABLE_PATH):
+        """
+        WordNet synonym lookup shared by ingestion and retrieval.
+        Lookups are served from the precomputed table if present, then from a bounded LRU
+        cache, and only then from WordNet.
+        :param cache_size: Number of words kept in the in-memory cache
+        :param table_path: JSON file written by build_synonym_table (ignored if missing)
+        """
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.lock = threading.Lock()
+        self.table = {}
+        if table_path and os.path.exists(table_path):
+            with open(table_path, 'r') as f:
+                self.table = json.load(f)
+            print(f"Loaded {len(self.table)} precomputed synonym entries from {table_path}")
+
+    @staticmethod
+    def lookup_wordnet(word):
+        """
+        All lemma names of all synsets of word, without duplicates, in WordNet order.
+        """
+        lemma_names = []
+        seen = set()
+        for syn in wordnet.synsets(word):
+            for lemma in syn.lemmas():
+                name = lemma.name()
+                if name not in seen:
+                    seen.add(name)
+                    lemma_names.append(name)
+        return lemma_names
+
+    def lemma_names(self, word):
+        if word in self.table:
+            return self.table[word]
+
+        with self.lock:
+            if word in self.cache:
+                self.cache.move_to_end(word)
+                self.cache_hits += 1
+                return self.cache[word]
+            self.cache_misses += 1
+
+        lemma_names = tuple(self.lookup_wordnet(word))
+
+        with self.lock:
+            self.cache[word] = lemma_names
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)  # Drop the least recently used word
+        return lemma_names
+
+    def get_synonyms(self, word, limit=None):
+        """
+        Get synonyms for a word from WordNet, limited to a certain number (None for all).
+        Returns the same set as collecting lemma names until `limit` distinct names were seen.
+        """
+        lemma_names = self.lemma_names(word)
+        if limit is not None:
+            lemma_names = lemma_names[:limit]
+        return list(lemma_names)
+
+    def cache_stats(self):
+        with self.lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "table_size": len(self.table),
+                "size": len(self.cache),
+                "max_size": self.cache_size,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            }
+
+
+# One synonym service per process
+_service = None
+_service_lock = threading.Lock()
+
+def get_synonym_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = SynonymService()
+    return _service
+
+
+def build_synonym_table(labels, table_path=SYNONYM_TABLE_PATH):
+    """
+    Precompute synonyms for every word of the given class labels and save them as JSON.
+    :param labels: Iterable of label strings, e.g. "sports car, sport car"
+    """
+    from nltk.tokenize import word_tokenize
+
+    words = set()
+    for label in labels:
+        for value in label.split(','):
+            value = value.strip()
+            words.add(value)
+            words.update(word_tokenize(value))
+
+    table = {word: SynonymService.lookup_wordnet(word) for word in sorted(words)}
+    with open(table_path, 'w') as f:
+        json.dump(table, f)
+    print(f"Wrote synonyms for {len(table)} words to {table_path}")
+    return table
+
+
+if __name__ == '__main__':
+    # Build the table for all ImageNet labels of the configured model:
+    #   cd backend/system && python -m tokenisation.synonymService
+    from transformers import AutoConfig
+    from methods.getFeaturesCNN import MODEL_PATH
+
+    config = AutoConfig.from_pretrained(MODEL_PATH)
+    build_synonym_table(config.id2label.values())
@@ -1,8 +1,8 @@
 import os
 from nltk.data import find
-from nltk.corpus import wordnet
 import nltk
 from nltk.tokenize import word_tokenize
+from tokenisation.synonymService import get_synonym_service
 
 # Set NLTK data path to the current folder
 nltk_data_path = os.path.join(os.getcwd(), 'nltk_data')
@@ -27,13 +27,7 @@ download_nltk_data()
 
 def get_synonyms(word, limit=3):
     """Get top synonyms for a given word from WordNet, limited to a certain number."""
-    synonyms = set()
-    for syn in wordnet.synsets(word):
-        for lemma in syn.lemmas():
-            synonyms.add(lemma.name())
-            if len(synonyms) >= limit:
-                return list(synonyms)
-    return list(synonyms)
+    return get_synonym_service().get_synonyms(word, limit=limit)
 
 def tokenize_phrase(phrase):
     """Tokenize multi-word phrases like 'sports car' into individual words."""
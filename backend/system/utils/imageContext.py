@@ -0,0 +1,38 @@
+from PIL import Image
+import numpy as np
+
+class ImageContext:
+    def __init__(self, filepath):
+        """
+        Decode an image file once for all ingestion stages.
+        Keeps the file-level information needed for metadata (format, mode, size, info, EXIF)
+        and the pixels as a read-only RGB NumPy array that analyzers can view without copying.
+        :param filepath: path to the image
+        """
+        self.filepath = filepath
+        with Image.open(filepath) as image:
+            # Read everything from the same handle before the pixel data is converted
+            self.format = image.format
+            self.mode = image.mode  # Original mode, e.g. RGB, RGBA, CMYK, L
+            self.size = image.size
+            self.info = dict(image.info)
+            self.exif = image._getexif() if hasattr(image, '_getexif') else None
+            self.orientation = (self.exif or {}).get(274, 1)  # EXIF Orientation tag
+
+            image.load()
+            rgb = image if image.mode == "RGB" else image.convert("RGB")
+            self.rgb = np.asarray(rgb)  # H x W x 3, uint8
+        self.rgb.flags.writeable = False  # Shared by every stage, nobody may modify it
+
+    @property
+    def bgr(self):
+        """Zero-copy BGR view of the pixels (OpenCV channel order)."""
+        return self.rgb[..., ::-1]
+
+    def crop(self, left, top, right, bottom):
+        """Zero-copy view of a region, same box convention as PIL's Image.crop."""
+        return self.rgb[top:bottom, left:right]
+
+    def pil_image(self):
+        """The pixels as a PIL RGB image (PIL cannot share memory with 3-channel arrays, so this copies)."""
+        return Image.fromarray(self.rgb)
@@ -0,0 +1,192 @@
+from PIL import Image, ImageOps
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+THUMBNAIL_DIR = os.environ.get('CBIR_THUMBNAIL_DIR', os.path.join(BACKEND_DIR, 'thumbnails'))
+THUMBNAIL_SIZES = (128, 256, 512)  # Longest side in pixels, one pyramid level each
+
+# EXIF orientation -> transpose that displays the image upright (as ImageOps.exif_transpose)
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def file_hash(filepath, chunk_size=1 << 20):
+    """Return the SHA-1 hex digest of a file, read in chunks."""
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class ThumbnailCache:
+    def __init__(self, cache_dir=THUMBNAIL_DIR, sizes=THUMBNAIL_SIZES, max_bytes=512 * 1024 * 1024, quality=85,
+                 hash_lookup=None, max_digests=10000):
+        """
+        Content-addressed JPEG thumbnails: <cache_dir>/<size>/<hash[:2]>/<hash>.jpg
+        Identical files share thumbnails, and a changed file gets new ones automatically.
+        :param sizes: Pyramid levels (longest side in pixels)
+        :param max_bytes: Least recently used thumbnails are evicted above this size
+        :param hash_lookup: Callable filename -> (content_hash, file_size) or None, e.g. from the
+                            images table, so serving a thumbnail does not hash the original
+        :param max_digests: Entries of the in-memory content hash memo (least recently used are dropped)
+        """
+        self.cache_dir = cache_dir
+        self.sizes = tuple(sorted(sizes))
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.hash_lookup = hash_lookup
+        self.max_digests = max_digests
+        self.digests = OrderedDict()  # (path, mtime_ns, size) -> content hash, least recently used first
+        self.total_bytes = None  # Computed on first use
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # Picklable for process workers; the lock, memo and lookup are per process
+        state = self.__dict__.copy()
+        del state['lock']
+        state['digests'] = OrderedDict()
+        state['hash_lookup'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def nearest_size(self, size):
+        """Smallest pyramid level that is at least `size` (the largest level otherwise)."""
+        for level in self.sizes:
+            if level >= size:
+                return level
+        return self.sizes[-1]
+
+    def content_hash(self, filepath):
+        stat = os.stat(filepath)
+        key = (filepath, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest is not None:
+                self.digests.move_to_end(key)
+                return digest
+        digest = file_hash(filepath)
+        with self.lock:
+            self.digests[key] = digest
+            while len(self.digests) > self.max_digests:
+                self.digests.popitem(last=False)
+        return digest
+
+    def known_hash(self, filepath):
+        """
+        Content hash recorded by hash_lookup when the file still has the recorded size,
+        otherwise the hash of the file itself.
+        """
+        if self.hash_lookup is not None:
+            known = self.hash_lookup(os.path.basename(filepath))
+            if known is not None and known[0] and known[1] == os.path.getsize(filepath):
+                return known[0]
+        return self.content_hash(filepath)
+
+    def thumbnail_path(self, digest, size):
+        return os.path.join(self.cache_dir, str(size), digest[:2], digest + '.jpg')
+
+    def create_thumbnails(self, filepath, image_context=None, digest=None):
+        """
+        Write every pyramid level of an image (skipping levels that already exist).
+        Each level is downscaled from the next larger one instead of from the original.
+        :param image_context: Already decoded ImageContext of filepath (optional)
+        :param digest: Known content hash of filepath (hashed otherwise)
+        :return: The content hash of the file.
+        """
+        digest = digest or self.content_hash(filepath)
+        missing = [size for size in self.sizes if not os.path.exists(self.thumbnail_path(digest, size))]
+        if not missing:
+            return digest
+
+        if image_context is not None:
+            img = image_context.pil_image()
+            transpose = EXIF_TRANSPOSE.get(image_context.orientation)
+            if transpose is not None:
+                img = img.transpose(transpose)
+        else:
+            img = ImageOps.exif_transpose(Image.open(filepath)).convert('RGB')  # Also drops alpha, JPEG has none
+        written = 0
+        for size in sorted(self.sizes, reverse=True):
+            img.thumbnail((size, size), Image.LANCZOS)  # Never upscales
+            if size in missing:
+                written += self._write(img, self.thumbnail_path(digest, size))
+        self._account(written)
+        return digest
+
+    def _write(self, img, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, format='JPEG', quality=self.quality, optimize=True)
+        os.replace(tmp_path, path)  # Readers never see a partial file
+        return os.path.getsize(path)
+
+    def get_thumbnail(self, filepath, size):
+        """
+        Path of the thumbnail of filepath at the nearest pyramid level, rebuilt on a miss.
+        """
+        size = self.nearest_size(size)
+        digest = self.known_hash(filepath)
+        path = self.thumbnail_path(digest, size)
+        if not os.path.exists(path):
+            self.create_thumbnails(filepath, digest=digest)
+        else:
+            os.utime(path)  # Mark as recently used for eviction
+        return path
+
+    def _account(self, written):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self._scan_size()
+            else:
+                self.total_bytes += written
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _scan_size(self):
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                total += os.path.getsize(os.path.join(root, name))
+        return total
+
+    def evict(self, target_ratio=0.9):
+        """
+        Delete least recently used thumbnails until the cache is below target_ratio * max_bytes.
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * target_ratio
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                continue
+        with self.lock:
+            self.total_bytes = total
@@ -0,0 +1,40 @@
+import hashlib
+import os
+import tempfile
+from utils.checkIfImage import is_valid_image
+
+class UploadTooLarge(Exception):
+    pass
+
+class NotAnImage(Exception):
+    pass
+
+def spool_upload(stream, directory, max_bytes=None, chunk_size=1 << 20):
+    """
+    Copy an upload stream to a temporary file in `directory`, chunk by chunk, hashing it
+    in the same pass, then let PIL verify it (every format PIL reads is accepted).
+    Memory use does not depend on the file size.
+    The temporary file is on the same file system as the storage folder, so it can be
+    moved into place atomically with os.replace.
+    :param max_bytes: Maximum file size; larger uploads raise UploadTooLarge
+    :return: (temporary path, SHA-1 hex digest, size in bytes). The caller owns the file.
+    :raises UploadTooLarge: the file exceeds max_bytes
+    :raises NotAnImage: PIL cannot identify or verify the file
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge(f"File exceeds {max_bytes} bytes")
+                sha1.update(chunk)
+                f.write(chunk)
+        if not is_valid_image(tmp_path):
+            raise NotAnImage("Not a valid image")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, sha1.hexdigest(), size
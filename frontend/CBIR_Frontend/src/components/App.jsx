@@ -18,6 +18,25 @@ const App = () => {
   const [searchPerformed, setSearchPerformed] = useState(false);
   const [searchQuery, setSearchQuery] = useState('');
   const [imageFilenames, setImageFilenames] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [nextSearchOffset, setNextSearchOffset] = useState(null);
+
+  // /search returns one page of results; has_more tells whether another page follows
+  const loadSearchPage = async (query, offset) => {
+    setLoading(true);
+    setError(null);
+    try {
+      const response = await axios.post('http://localhost:5000/search', { query, offset });
+      setImages(prev => [...prev, ...response.data.images]);
+      setImageFilenames(prev => [...prev, ...response.data.filenames]);
+      setNextSearchOffset(response.data.has_more ? response.data.next_offset : null);
+    } catch (err) {
+      console.error('Error fetching images:', err);
+      setError('Failed to fetch images. Please try again.');
+    } finally {
+      setLoading(false);
+    }
+  };
 
   const handleSearch = async (query) => {
     setSearchQuery(query);
@@ -28,38 +47,36 @@ const App = () => {
       return;
     }
 
-    setLoading(true);
-    setError(null);
     setSearchPerformed(true);
     setImages([]);
     setImageFilenames([]);
-
-    try {
-      const response = await axios.post('http://localhost:5000/search', { query });
-      setImages(response.data.images);
-      setImageFilenames(response.data.filenames);
-    } catch (err) {
-      console.error('Error fetching images:', err);
-      setError('Failed to fetch images. Please try again.');
-    } finally {
-      setLoading(false);
-    }
+    setNextCursor(null);
+    setNextSearchOffset(null);
+    await loadSearchPage(query, 0);
   };
 
   const { isDarkMode, toggleTheme } = useTheme();
 
-  const handleGetAllImages = async () => {
+  // /all_images streams one JSON object per line; the last line holds the next page cursor
+  const fetchImagePage = async (cursor) => {
+    const response = await fetch(`http://localhost:5000/all_images?cursor=${cursor}`);
+    if (!response.ok) {
+      throw new Error(`Server responded with ${response.status}`);
+    }
+    const lines = (await response.text()).split('\n').filter(line => line.trim());
+    const records = lines.map(line => JSON.parse(line));
+    const footer = records.pop();
+    return { records, nextCursor: footer.next_cursor };
+  };
+
+  const loadImagePage = async (cursor) => {
     setLoading(true);
     setError(null);
-    setSearchPerformed(false);
-    setSearchQuery('');
-    setImages([]);
-    setImageFilenames([]);
-
     try {
-      const response = await axios.get('http://localhost:5000/all_images');
-      setImages(response.data.images);
-      setImageFilenames(response.data.filenames);
+      const page = await fetchImagePage(cursor);
+      setImages(prev => [...prev, ...page.records.map(record => record.thumbnail)]);
+      setImageFilenames(prev => [...prev, ...page.records.map(record => record.filename)]);
+      setNextCursor(page.nextCursor);
     } catch (err) {
       console.error('Error fetching all images:', err);
       setError('Failed to fetch all images. Please try again.');
@@ -68,6 +85,16 @@ const App = () => {
     }
   };
 
+  const handleGetAllImages = async () => {
+    setSearchPerformed(false);
+    setSearchQuery('');
+    setImages([]);
+    setImageFilenames([]);
+    setNextCursor(null);
+    setNextSearchOffset(null);
+    await loadImagePage(0);
+  };
+
   useEffect(() => {
     handleGetAllImages();
   }, []);
@@ -101,6 +128,16 @@ const App = () => {
         )}
         <div style={{ display: 'flex', flexDirection: 'column', alignItems: 'center' }}>
         <ImageGrid images={images} query={searchQuery} filenames={imageFilenames} />
+        {!searchPerformed && nextCursor !== null && !loading && (
+          <button className="load-more-button" onClick={() => loadImagePage(nextCursor)}>
+            Load more
+          </button>
+        )}
+        {searchPerformed && nextSearchOffset !== null && !loading && (
+          <button className="load-more-button" onClick={() => loadSearchPage(searchQuery, nextSearchOffset)}>
+            Load more
+          </button>
+        )}
         </div>
       </main>
       <Footer />
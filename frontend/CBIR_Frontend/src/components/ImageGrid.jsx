@@ -81,7 +81,7 @@
          const filename = filenames[index]; // Get the filename for the current image
         return (
           <div key={index} className="image-item">
-            <img src={`data:image/jpeg;base64,${image}`} alt={`Result ${index}`} />
+            <img src={image} alt={`Result ${index}`} loading="lazy" />
             <div className="feedback-buttons">
               <button
                 className="feedback-button positive"